@@ -2,6 +2,15 @@ import random
 import re
 
 import numpy as np
+import pandas as pd
+
+
+def object_array(values):
+    """ 1-d object array of values, which may be equal-length arrays numpy would otherwise stack """
+    res = np.empty(len(values), dtype=np.object_)
+    for i, v in enumerate(values):
+        res[i] = v
+    return res
 
 
 class RandomCrop:
@@ -30,20 +39,44 @@ class RandomCrop:
         return ' '.join(words[offset:offset+length])
 
 
+class RandomCropIds(RandomCrop):
+    """ RandomCrop of pre-tokenized comments, `comment_text` holds int32 token id arrays """
+
+    token_ids = True
+
+    def transform(self, X):
+        ids = X['comment_text'].values
+        lengths = np.array([len(a) for a in ids], dtype=np.int64)
+
+        min_len = np.full(len(ids), self.min_len) if isinstance(self.min_len, int) else np.ceil(self.min_len * lengths).astype(np.int64)
+        max_len = np.full(len(ids), self.max_len) if isinstance(self.max_len, int) else np.ceil(self.max_len * lengths).astype(np.int64)
+
+        max_len = np.minimum(max_len, lengths)
+        min_len = np.minimum(min_len, max_len)
+
+        length = min_len + (np.random.rand(len(ids)) * (max_len - min_len + 1)).astype(np.int64)
+        offset = (np.random.rand(len(ids)) * (lengths - length + 1)).astype(np.int64)
+
+        X = X.copy()
+        X['comment_text'] = object_array([a[o:o+l] for a, o, l in zip(ids, offset, length)])
+        return X
+
+
 class RandomTranslation:
 
-    def __init__(self, prob=0.2):
+    def __init__(self, prob=0.2, langs=('de', 'fr', 'es')):
         self.prob = prob
-        self.langs = ['de', 'fr', 'es']
+        self.langs = list(langs)
 
     def transform(self, X):
-        replace = np.random.rand(len(X))
-        langs = np.random.choice(self.langs, size=len(X))
+        replace = np.flatnonzero(np.random.rand(len(X)) < self.prob)
+        langs = np.random.randint(len(self.langs), size=len(X))[replace]
+
+        texts = X['comment_text'].values.copy()
+        texts[replace] = X[['comment_text__%s' % lang for lang in self.langs]].values[replace, langs]
 
         res = X.copy()
-        for i, r, lang in zip(X.index, replace, langs):
-            if r < self.prob:
-                res.loc[i, 'comment_text'] = X.loc[i, 'comment_text__%s' % lang]
+        res['comment_text'] = texts
         return res
 
 
@@ -57,27 +90,43 @@ class RandomConcat:
 
     def fit(self, X, y):
         if self.max_len is not None:
-            selected = (X['comment_text'].map(lambda t: len(re.split('\W+', t))) < self.max_len).values
-            self.cand_X = X.loc[selected]
-            self.cand_y = y.loc[selected]
+            selected = self._lengths(X['comment_text'].values) < self.max_len
         else:
-            self.cand_X = X
-            self.cand_y = y
+            selected = np.ones(len(X), dtype=np.bool_)
+
+        self.cand_texts = X['comment_text'].values[selected]
+        self.cand_y = y.values[selected].astype(np.float32)
 
     def transform(self, X, y):
+        selected = np.flatnonzero(np.random.rand(len(X)) < self.prob)
+        cands = np.random.randint(len(self.cand_texts), size=len(selected))
+        orig_first = np.random.rand(len(selected)) > 0.5
+
+        texts = X['comment_text'].values.copy()
+        orig, cand = texts[selected], self.cand_texts[cands]
+        texts[selected] = self._concat(orig, cand, orig_first)
+
+        labels = y.values.astype(np.float32)
+        labels[selected] = np.clip(labels[selected] * self.orig_weight + self.cand_y[cands] * self.new_weight, 0.0, 1.0)
+
         X = X.copy()
-        y = y.copy().astype(np.float32)
+        X['comment_text'] = texts
+        return X, pd.DataFrame(labels, index=y.index, columns=y.columns)
+
+    def _lengths(self, texts):
+        return np.array([len(re.split('\W+', t)) for t in texts])
+
+    def _concat(self, orig, cand, orig_first):
+        return np.where(orig_first, orig + ' ' + cand, cand + ' ' + orig)
+
 
-        for idx, r in zip(X.index, np.random.rand(len(X))):
-            if r >= self.prob:
-                continue
-            cand_idx = np.random.choice(self.cand_X.index)
+class RandomConcatIds(RandomConcat):
+    """ RandomConcat of pre-tokenized comments, `comment_text` holds int32 token id arrays and max_len is in tokens """
 
-            if np.random.rand() > 0.5:
-                X.loc[idx, 'comment_text'] = '%s %s' % (X.loc[idx, 'comment_text'], self.cand_X.loc[cand_idx, 'comment_text'])
-            else:
-                X.loc[idx, 'comment_text'] = '%s %s' % (self.cand_X.loc[cand_idx, 'comment_text'], X.loc[idx, 'comment_text'])
+    token_ids = True
 
-            y.loc[idx] = (y.loc[idx] * self.orig_weight + self.cand_y.loc[cand_idx] * self.new_weight).clip(lower=0.0, upper=1.0)
+    def _lengths(self, texts):
+        return np.array([len(ids) for ids in texts])
 
-        return X, y
+    def _concat(self, orig, cand, orig_first):
+        return object_array([np.concatenate((o, c) if f else (c, o)) for o, c, f in zip(orig, cand, orig_first)])
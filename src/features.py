@@ -1,8 +1,8 @@
 import re
 import os
-import time
+import json
+import hashlib
 import string
-import threading
 import unicodedata
 import unidecode
 
@@ -10,161 +10,602 @@ import pandas as pd
 import numpy as np
 
 from collections import Counter
+from functools import partial, lru_cache
+from bisect import bisect_left
 
 from nltk.sentiment.vader import SentimentIntensityAnalyzer
 from nltk import tokenize
 
 from joblib import Parallel, delayed
 
+from src.util.correction_cache import CorrectionCache
+from src.util.embeddings import EmbeddingIndex
 
-def count_regexp_occ(regexp, text):
-    """ Simple way to get the number of occurence of a regex"""
-    return len(re.findall(regexp, text))
 
+map_jobs = int(os.getenv('MAP_JOBS', os.cpu_count()))
+cache_dir = os.getenv('CACHE_DIR', 'cache')
 
+# Settings which don't change feature values, so they are left out of code fingerprints
+runtime_settings = {'map_jobs', 'cache_dir', 'sentiment_cache_size'}
+
+
+def reads(*filenames):
+    """ Declare input files feature depends on, so the cache is invalidated when they change """
+    def decorator(fn):
+        fn.input_files = filenames
+        return fn
+    return decorator
+
+
+def row_local(fn):
+    """
+    Mark feature which value for each row depends only on that row, so it can be computed for new rows only.
+    Other features (like corrections using corpus-wide vocabulary) are recomputed on the whole data when input changes.
+    """
+    fn.row_local = True
+    return fn
+
+
+def fuses(*names):
+    """
+    Declare function computing several features in a single pass over their common dependencies.
+    It's called with these dependencies and the list of names to compute and returns name -> frame dict,
+    each frame should be equal to the one returned by the feature function of that name.
+    """
+    def decorator(fn):
+        fn.fused_names = names
+        return fn
+    return decorator
+
+
+def map_chunks(fn, df, n_jobs=None, chunk_size=None):
+    """ Apply fn to consecutive row chunks of df in worker processes, results are concatenated in the original order """
+    n_jobs = n_jobs or map_jobs
+    chunk_size = chunk_size or max(1000, int(np.ceil(len(df) / (n_jobs * 4))))
+
+    if n_jobs <= 1 or len(df) <= chunk_size:
+        return fn(df)
+
+    with Parallel(n_jobs) as parallel:
+        return pd.concat(parallel(delayed(fn)(df.iloc[ofs:ofs+chunk_size]) for ofs in range(0, len(df), chunk_size)))
+
+
+def applymap_chunk(fn, df):
+    return df.applymap(fn)
+
+
+def factorize_values(values):
+    """ Codes and distinct values of flat array, unlike pd.factorize missing value is kept as one of distinct values """
+    codes, uniques = pd.factorize(values)
+    uniques = np.asarray(uniques, dtype=np.object_)
+
+    nulls = codes < 0
+    if nulls.any():
+        uniques = np.append(uniques, values[nulls.argmax()])
+        codes[nulls] = len(uniques) - 1
+
+    return codes, uniques
+
+
+def map_unique(fn, values, **kwargs):
+    """ Apply fn once to each distinct value of array in parallel chunks and broadcast results back to array shape """
+    values = np.asarray(values, dtype=np.object_)
+    codes, uniques = factorize_values(values.ravel())
+
+    results = map_chunks(partial(applymap_chunk, fn), pd.DataFrame({'value': uniques}), **kwargs)['value'].values
+    return results[codes].reshape(values.shape)
+
+
+def map_unique_rows(fn, series, **kwargs):
+    """ Apply batch fn (Series -> DataFrame) to distinct values of series in parallel chunks and broadcast result rows back """
+    codes, uniques = factorize_values(np.asarray(series, dtype=np.object_))
+
+    res = map_chunks(fn, pd.Series(uniques), **kwargs).iloc[codes]
+    res.index = series.index
+    return res
+
+
+def parallel_applymap(df, fn, **kwargs):
+    """ Parallel version of DataFrame.applymap calling fn once per distinct value, fn should be picklable (module-level function, partial or object) """
+    return pd.DataFrame(map_unique(fn, df.values, **kwargs), index=df.index, columns=df.columns).infer_objects()
+
+
+class Rewriter:
+    """
+    Sequence of text rewriting steps compiled once and applied in order.
+
+    Step is either a text -> text function, a `(pattern, repl)` / `(pattern, repl, guards)` substitution rule
+    (rule with guards is skipped for texts containing none of guard substrings), or a list of rules fused
+    into a single alternation pass. Fusing is valid only for rules whose matches neither overlap
+    nor create or remove matches of each other (including changing the context of \\b assertions).
+    """
+
+    def __init__(self, *steps):
+        self.steps = steps
+        self.passes = [self._compile(step) for step in steps]
+
+    def __call__(self, text):
+        for fn, guards in self.passes:
+            if guards is None or any(g in text for g in guards):
+                text = fn(text)
+        return text
+
+    def _compile(self, step):
+        if callable(step):
+            return step, None
+
+        if isinstance(step, tuple):
+            pattern, repl, guards = step if len(step) == 3 else step + (None,)
+            return partial(re.compile(pattern).sub, repl), guards
+
+        patterns, repls, guards = [], {}, set()
+        num_groups = 0
+        for i, (pattern, repl, *rule_guards) in enumerate(step):
+            pattern = re.compile(pattern)
+            if pattern.flags & ~re.UNICODE or re.search(r'\\[1-9]|\(\?P=', pattern.pattern):
+                raise ValueError("Can't fuse rule %r with flags or backreferences" % pattern.pattern)
+
+            # Shift group references of replacement template by the number of groups before the rule
+            shift = lambda m: '\\g<%d>' % (int(m.group(1) or m.group(2)) + num_groups + 1)
+            repls['r%d' % i] = re.sub(r'\\g<(\d+)>|\\(\d+)', shift, repl)
+
+            patterns.append('(?P<r%d>%s)' % (i, pattern.pattern))
+            num_groups += pattern.groups + 1
+
+            if guards is not None:
+                guards = guards.union(rule_guards[0]) if len(rule_guards) > 0 and rule_guards[0] is not None else None
+
+        pattern = re.compile('|'.join(patterns))
+        return partial(pattern.sub, partial(self._fused_repl, repls)), guards
+
+    @staticmethod
+    def _fused_repl(repls, m):
+        repl = repls[m.lastgroup]
+        return m.expand(repl) if '\\' in repl else repl
+
+
+def to_ascii(line):
+    """ Normalize unicode and remove non-ascii symbols, skipping the normalization for pure ascii lines """
+    try:
+        line.encode('ascii')
+        return line
+    except UnicodeEncodeError:
+        return unicodedata.normalize('NFKD', line).encode("ascii", errors="ignore").decode()
+
+
+def pad(line):
+    return ' ' + line + ' '
+
+
+class SpacedNumber:
+    """
+    Replacement for a number match, equivalent to sequentially applying
+    `(\\d)([^\\d])` -> `\\1 \\2`, `([^\\d])(\\d)` -> `\\1 \\2` and replacing numbers longer than min_len with repl
+    """
+
+    def __init__(self, repl, min_len=1):
+        self.repl = repl
+        self.min_len = min_len
+
+    def __call__(self, m):
+        start, end = m.span()
+        number = m.group() if end - start < self.min_len else self.repl
+        return ('' if start == 0 else ' ') + number + ('' if end == len(m.string) else ' ')
+
+
+non_word_pattern = re.compile(r'\W')
+
+
+def join_spelled_word(m):
+    return non_word_pattern.sub('', m.group())
+
+
+clean1_rewriter = Rewriter(
+    pad, str.lower,
+    (r'[\s\n\t_]+', ' '),  # replace sequence of spacing symbols with single space
+
+    ('([0-9a-f]+:+)+[0-9a-f]+', 'iptoken', [':']),  # ipv6 addresses
+    ('([0-9]+\\.+)+[0-9]+', 'iptoken', ['.']),  # ipv4 addresses
+
+    (r'\d+', SpacedNumber('00', min_len=2)),  # split 5million and wikipedia86, replace big numerics with 00
+    str.strip
+)
+
+
+def clean1_line(line):
+    return clean1_rewriter(line)
+
+
+@row_local
 def clean1(raw):
-    def clean(line):
-        line = re.sub('[\s\n\t_]+', ' ', ' ' + line.lower() + ' ')  # replace sequence of spacing symbols with single space
+    return parallel_applymap(raw, clean1_line)
+
+
+url_pattern = re.compile(r"""(?i)\b((?:[a-z][\w-]+:(?:/{1,3}|[a-z0-9%])|www\d{0,3}[.]|[a-z0-9.\-]+[.][a-z]{2,4}/)(?:[^\s()<>]+|\(([^\s()<>]+|(\([^\s()<>]+\)))*\))+(?:\(([^\s()<>]+|(\([^\s()<>]+\)))*\)|[^\s`!()\[\]{};:'".,<>?«»“”‘’]))""")
+
+
+clean2_rewriter = Rewriter(
+    pad, str.lower,
+    (r'[\s\n\t_]+', ' '),  # replace sequence of spacing symbols with single space
+    ('\xad', '', ['\xad']),
+    (r'\[\d+\]', '', ['[']),  # remove wiki references
+    to_ascii,  # normalize unicode and remove non-ascii
+
+    (url_pattern, ' urltoken ', [':', 'www', '/']),  # urls
+
+    (r'([0-9a-f]+:+)[0-9a-f]+', ' iptoken ', [':']),  # ipv6 addresses
+    (r'([0-9]+\.+){2,}[0-9]+', ' iptoken ', ['.']),  # ipv4 addresses
 
-        line = re.sub('([0-9a-f]+:+)+[0-9a-f]+', 'iptoken', line)  # ipv6 addresses
-        line = re.sub('([0-9]+\\.+)+[0-9]+', 'iptoken', line)  # ipv4 addresses
+    (r'\d+', SpacedNumber('00', min_len=2)),  # split 5million and wikipedia86, replace big numerics with 00
 
-        line = re.sub('(\d)([^\d])', '\\1 \\2', line)  # split 5million
-        line = re.sub('([^\d])(\d)', '\\1 \\2', line)  # split wikipedia86
-        line = re.sub('\d\d+', '00', line)  # replace big numerics with 00
-        return line.strip()
+    (r'(.)\1{2,}', r'\1'),  # replace identical consecutive characters
+)
 
-    return raw.applymap(clean)
 
+def clean2_line(line):
+    return clean2_rewriter(line)
 
+
+@row_local
 def clean2(raw):
-    url_pattern = re.compile(r"""(?i)\b((?:[a-z][\w-]+:(?:/{1,3}|[a-z0-9%])|www\d{0,3}[.]|[a-z0-9.\-]+[.][a-z]{2,4}/)(?:[^\s()<>]+|\(([^\s()<>]+|(\([^\s()<>]+\)))*\))+(?:\(([^\s()<>]+|(\([^\s()<>]+\)))*\)|[^\s`!()\[\]{};:'".,<>?«»“”‘’]))""")
+    return parallel_applymap(raw, clean2_line)
 
-    def clean(line):
-        line = re.sub(r'[\s\n\t_]+', ' ', ' ' + line.lower() + ' ')  # replace sequence of spacing symbols with single space
-        line = line.replace('\xad', '')
-        line = re.sub(r'\[\d+\]', '', line)  # remove wiki references
-        line = unicodedata.normalize('NFKD', line)  # normalize unicode
-        line = line.encode("ascii", errors="ignore").decode()  # remove non-ascii
 
-        line = re.sub(url_pattern, ' urltoken ', line)  # urls
+def edits1(word, alphabet=string.ascii_lowercase):
+    splits = [(word[:i], word[i:]) for i in range(len(word) + 1)]
+    deletes = [a + b[1:] for a, b in splits if b]
+    transposes = [a + b[1] + b[0] + b[2:] for a, b in splits if len(b) > 1]
+    replaces = [a + c + b[1:] for a, b in splits for c in alphabet if b]
+    inserts = [a + c + b for a, b in splits for c in alphabet]
+    return (deletes + transposes + replaces + inserts)
 
-        line = re.sub(r'([0-9a-f]+:+)[0-9a-f]+', ' iptoken ', line)  # ipv6 addresses
-        line = re.sub(r'([0-9]+\.+){2,}[0-9]+', ' iptoken ', line)  # ipv4 addresses
 
-        line = re.sub(r'(\d)([^\d])', '\\1 \\2', line)  # split 5million
-        line = re.sub(r'([^\d])(\d)', '\\1 \\2', line)  # split wikipedia86
-        line = re.sub(r'\d\d+', '00', line)  # replace big numerics with 00
+def deletes1(word):
+    return set(word[:i] + word[i+1:] for i in range(len(word)))
 
-        line = re.sub(r'(.)\1{2,}', r'\1', line)  # replace identical consecutive characters
 
-        return line
+def is_edit1(word, cand, alphabet=string.ascii_lowercase):
+    """ Check if cand is in edits1(word, alphabet) without generating them """
+    if len(cand) == len(word) - 1:
+        return any(word[:i] + word[i+1:] == cand for i in range(len(word)))
 
-    return raw.applymap(clean)
+    if len(cand) == len(word) + 1:
+        return any(cand[i] in alphabet and cand[:i] + cand[i+1:] == word for i in range(len(cand)))
 
+    if len(cand) != len(word):
+        return False
 
-def apply_corrections(df, vectors):
-    alphabet = string.ascii_lowercase
-    corrector_cache = {}
+    diff = [i for i in range(len(word)) if word[i] != cand[i]]
+    if len(diff) == 0:  # Identity is produced by transposing equal letters or replacing a letter with itself
+        return any(c in alphabet for c in word) or any(a == b for a, b in zip(word, word[1:]))
+    if len(diff) == 1:
+        return cand[diff[0]] in alphabet
+    if len(diff) == 2:
+        i, j = diff
+        return j == i + 1 and word[i] == cand[j] and word[j] == cand[i]
+    return False
 
-    fasttext_voc = set(line.split()[0] for line in open(vectors))
-    clean_voc = Counter(w for line in df['comment_text'] for w in re.findall(r'(?u)\b\w\w+\b', line) if w in fasttext_voc)
 
-    def edits1(word):
-        splits = [(word[:i], word[i:]) for i in range(len(word) + 1)]
-        deletes = [a + b[1:] for a, b in splits if b]
-        transposes = [a + b[1] + b[0] + b[2:] for a, b in splits if len(b) > 1]
-        replaces = [a + c + b[1:] for a, b in splits for c in alphabet if b]
-        inserts = [a + c + b for a, b in splits for c in alphabet]
-        return (deletes + transposes + replaces + inserts)
+def deletes2(word):
+    """ Words with one or two letters deleted """
+    d1 = deletes1(word)
+    return d1.union(*map(deletes1, d1))
 
-    def correct(word):
-        if word in clean_voc:
-            return [word]
 
-        corrs = corrector_cache.get(word)
-        if corrs is not None:
-            return corrs
+def is_edit2(word, cand):
+    """ Check if cand is in edits1 of edits1(word) """
+    return any(is_edit1(w, cand) for w in set(edits1(word)))
+
+
+class DeletionIndex:
+    """
+    Symmetric delete index over vocabulary.
+
+    Every vocabulary word is indexed by itself and all its single-letter deletes, so words
+    from edits1(word) are found by probing word and its deletes instead of all 54n+25 edits.
+    Frequencies are looked up in voc passed to search methods (index vocabulary by default).
+    """
+
+    def __init__(self, voc):
+        self.voc = voc
+        self.index = {}
+
+        for w in voc:
+            self.index.setdefault(w, []).append(w)
+            for d in deletes1(w):
+                self.index.setdefault(d, []).append(w)
 
-        corrs, corr_freq = None, 0
-        for cand in edits1(word):
-            cand_freq = clean_voc.get(cand, 0)
+    def best_edit1(self, word, voc=None):
+        """ First most frequent vocabulary word in edits1(word) order, same as a linear scan over edits1 """
+        voc = self.voc if voc is None else voc
+
+        cands = set(w for key in deletes1(word) | {word} for w in self.index.get(key, ()) if is_edit1(word, w))
+        if len(cands) == 0:
+            return None, 0
+
+        freqs = {w: voc[w] for w in cands}
+        best_freq = max(freqs.values())
+        best = [w for w in cands if freqs[w] == best_freq]
+        if len(best) > 1:  # Resolve ties by enumeration order
+            best = [next(w for w in edits1(word) if voc.get(w, 0) == best_freq)]
+        return best[0], best_freq
+
+    def best_edit2(self, word, voc=None):
+        """ First most frequent vocabulary word in edits1 of edits1(word) order """
+        corr, corr_freq = None, 0
+        for precand in dict.fromkeys(edits1(word)):
+            cand, cand_freq = self.best_edit1(precand, voc)
             if cand_freq > corr_freq:
-                corrs = [cand]
-                corr_freq = cand_freq
+                corr, corr_freq = cand, cand_freq
+        return corr, corr_freq
+
+
+class NearWordsIndex:
+    """ Words indexed by their deletes of up to two letters, to check if some are in edits of given words """
+
+    def __init__(self, words):
+        self.index = {}
+
+        for w in words:
+            for d in deletes2(w) | {w}:
+                self.index.setdefault(d, []).append(w)
+
+    def has_near(self, probes):
+        """ Check if some indexed word is in edits1 of a probe word (depth 1) or in edits1 of its edits1 (depth 2) """
+        for word, depth in probes.items():
+            keys = (deletes2(word) if depth > 1 else deletes1(word)) | {word}
+            for cand in set(c for key in keys for c in self.index.get(key, ())):
+                if is_edit1(word, cand) or (depth > 1 and is_edit2(word, cand)):
+                    return True
+        return False
+
+
+class VocLookups:
+    """
+    Vocabulary view recording what a correction depends on: frequencies of all looked up words (0 for missing)
+    and probes - words which edits were searched in vocabulary, with edit depth.
+    """
+
+    def __init__(self, voc):
+        self.voc = voc
+        self.deps = {}
+        self.probes = {}
+
+    def get(self, word, default=0):
+        self.deps[word] = self.voc.get(word, 0)
+        return self.deps[word] or default
+
+    def __getitem__(self, word):
+        return self.get(word)
+
+    def add(self, deps, probes):
+        self.deps.update(deps)
+        for word, depth in probes.items():
+            self.probes[word] = max(depth, self.probes.get(word, 0))
+
+
+def get_voc_hash(voc):
+    return hashlib.sha1(repr(sorted(voc.items())).encode()).hexdigest()[:16]
+
+
+def get_deletion_index(voc, voc_hash, indexes={}):
+    """ Deletion index of vocabulary, built once per process (chunk workers included) """
+    if voc_hash not in indexes:
+        indexes.clear()  # Index is much larger than vocabulary, keep only the last one
+        indexes[voc_hash] = DeletionIndex(voc)
+    return indexes[voc_hash]
+
+
+class Corrector:
+    """
+    Corrects words missing in vocabulary to frequent vocabulary words in their edits.
+
+    Corrections may be persisted in CorrectionCache shared by all corpora corrected to the same vectors.
+    Every correction is stored with the frequencies and probes it depends on (see VocLookups), and is reused
+    with another vocabulary only if these frequencies are the same and no word missing in its original vocabulary
+    is in probes edits, so it's always the same as computed from scratch.
+    """
+
+    token_pattern = re.compile(r'(?u)\b\w\w+\b')
+    version = 2  # Bump on changes of correction logic to invalidate persisted corrections
+
+    def __init__(self, voc, cache=None):
+        self.voc = voc
+        self.voc_hash = get_voc_hash(voc)
+        self.persistent = cache
+        self.cache = {}
+        self.sources = {}  # Word -> json of deps and probes of its correction
+        self.computed = []
+
+    def get_index(self):
+        return get_deletion_index(self.voc, self.voc_hash)
 
-        if corrs is not None:
-            corrector_cache[word] = corrs
-            return corrs
+    def correct(self, word):
+        if word in self.voc:
+            return [word]
+
+        corrs = self.cache.get(word)
+        if corrs is None:
+            voc = VocLookups(self.voc)
+            corrs = self.correct_missing(word, voc)
+
+            self.cache[word] = corrs
+            self.sources[word] = json.dumps(voc.deps), json.dumps(voc.probes)
+            self.computed.append(word)
+
+        return corrs
+
+    def correct_part(self, word, voc):
+        """ Correct part of a word being corrected with voc, recording what part correction depends on """
+        if voc.get(word) > 0:
+            return [word]
+
+        corrs = self.correct(word)
+        voc.add(*map(json.loads, self.sources[word]))
+        return corrs
+
+    def best_edit(self, word, depth, voc):
+        voc.add({}, {word: depth})
+        if depth == 1:
+            return self.get_index().best_edit1(word, voc)
+        return self.get_index().best_edit2(word, voc)
+
+    def correct_missing(self, word, voc):
+        corr, _ = self.best_edit(word, 1, voc)
+        if corr is not None:
+            return [corr]
 
         if len(word) > 5 and len(word) < 30:
             for sz in reversed(range(1, min(len(word) - 1, 10))):
-                if clean_voc.get(word[:sz], 0) > 100:
-                    corrs = [word[:sz]] + correct(word[sz:])
-                    corrector_cache[word] = corrs
-                    return corrs
+                if voc.get(word[:sz]) > 100:
+                    return [word[:sz]] + self.correct_part(word[sz:], voc)
 
-        corrs = [word]
-        corrector_cache[word] = corrs
-        return corrs
+        return [word]
 
-    def correct_line(line):
+    def __call__(self, line):
         if isinstance(line, float):  # skip nan
             return line
 
-        words = re.findall(r'(?u)\b\w\w+\b', line)
-        words = [sw for w in words for sw in correct(w)]
+        words = self.token_pattern.findall(line)
+        words = [sw for w in words for sw in self.correct(w)]
         return ' '.join(words)
 
-    return df.applymap(correct_line)
+    def load_cache(self):
+        """ Load persisted corrections which are the same with this vocabulary """
+        self.persistent.save_vocabulary(self.voc_hash, list(self.voc))
+
+        added = {}  # Vocabulary hash -> index of words missing in that vocabulary
+        for word, voc_hash, corrs, deps, probes in self.persistent.load():
+            if word in self.voc or word in self.cache:
+                continue
+
+            if voc_hash != self.voc_hash:
+                if any(self.voc.get(w, 0) != f for w, f in json.loads(deps).items()):
+                    continue
+
+                if voc_hash not in added:
+                    voc_words = self.persistent.load_vocabulary(voc_hash)
+                    added[voc_hash] = None if voc_words is None else NearWordsIndex(set(self.voc) - voc_words)
+                if added[voc_hash] is None or added[voc_hash].has_near(json.loads(probes)):
+                    continue
+
+            self.cache[word] = corrs
+            self.sources[word] = deps, probes
 
+    def apply(self, df):
+        """ Correct all cells of df, persisting new corrections """
+        res = df.applymap(self)
 
+        if self.persistent is not None:
+            self.persistent.save(self.voc_hash, [(w, self.cache[w]) + self.sources[w] for w in self.computed])
+
+        return res
+
+
+def get_correction_cache(corrector_cls, vectors):
+    """ Corrections are shared by all corpora corrected to the vectors vocabulary by the same corrector version """
+    return CorrectionCache(os.path.join(cache_dir, 'corrections', '%s-%s-v%d.sqlite' % (os.path.basename(vectors), corrector_cls.__name__, corrector_cls.version)))
+
+
+def apply_corrections(df, vectors, corrector_cls=Corrector):
+    fasttext_voc = EmbeddingIndex.load(vectors, cache_dir).vocabulary()
+    clean_voc = Counter(w for line in df['comment_text'] for w in corrector_cls.token_pattern.findall(line) if w in fasttext_voc)
+
+    corrector = corrector_cls(clean_voc, get_correction_cache(corrector_cls, vectors))
+    corrector.load_cache()
+
+    return map_chunks(corrector.apply, df)
+
+
+@reads('input/crawl-300d-2M.vec')
 def clean2_corrected_fasttext(clean2):
     return apply_corrections(clean2, 'input/crawl-300d-2M.vec')
 
 
+punct_pattern = re.compile(r'[^\w\s]')
+
+
+def rm_punct(x):
+    return punct_pattern.sub(' ', x)
+
+
+@row_local
 def clean2_no_punct(clean2):
-    def rm_punct(x):
-        return re.sub(r'[^\w\s]', ' ', x)
+    return parallel_applymap(clean2, rm_punct)
+
+
+expand_patterns = [
+    (r'US', 'United States', ['US']),
+    (r'IT', 'Information Technology', ['IT']),
+    (r'(W|w)on\'t', 'will not', ["on't"]),
+    (r'(C|c)an\'t', 'can not', ["an't"]),
+    (r'(I|i)\'m', 'i am', ["'m"]),
+    (r'(A|a)in\'t', 'is not', ["in't"]),
+    (r'(\w+)\'ll', '\g<1> will', ["'ll"]),
+    (r'(\w+)n\'t', '\g<1> not', ["n't"]),
+    (r'(\w+)\'ve', '\g<1> have', ["'ve"]),
+    (r'(\w+)\'s', '\g<1> is', ["'s"]),
+    (r'(\w+)\'re', '\g<1> are', ["'re"]),
+    (r'(\w+)\'d', '\g<1> would', ["'d"]),
+]
 
-    return clean2.applymap(rm_punct)
+expand_rewriter = Rewriter(*expand_patterns)
 
 
+def expand_rm_punct(x):
+    return rm_punct(expand_rewriter(x))
+
+
+@row_local
 def clean2_expand_no_punct(clean2):
-    expand_patterns = [
-        (r'US', 'United States'),
-        (r'IT', 'Information Technology'),
-        (r'(W|w)on\'t', 'will not'),
-        (r'(C|c)an\'t', 'can not'),
-        (r'(I|i)\'m', 'i am'),
-        (r'(A|a)in\'t', 'is not'),
-        (r'(\w+)\'ll', '\g<1> will'),
-        (r'(\w+)n\'t', '\g<1> not'),
-        (r'(\w+)\'ve', '\g<1> have'),
-        (r'(\w+)\'s', '\g<1> is'),
-        (r'(\w+)\'re', '\g<1> are'),
-        (r'(\w+)\'d', '\g<1> would'),
-    ]
-
-    def expand_rm_punct(x):
-        for pattern, repl in expand_patterns:
-            x = re.sub(pattern, repl, x)
-        return re.sub(r'[^\w\s]', ' ', x)
-
-    return clean2.applymap(expand_rm_punct)
+    return parallel_applymap(clean2, expand_rm_punct)
 
 
-def clean2_expand_no_punct_lemmatize(clean2_expand_no_punct):
+@lru_cache(maxsize=None)
+def get_lemmatizer():
     from nltk.stem import WordNetLemmatizer
 
-    wordnet_lemmatizer = WordNetLemmatizer()
+    return WordNetLemmatizer()
+
+
+@lru_cache(maxsize=2 ** 20)
+def lemmatize_word(word):
+    return get_lemmatizer().lemmatize(word)
 
-    def lemmatize(x):
-        return ' '.join(map(wordnet_lemmatizer.lemmatize, x.split()))
 
-    return clean2_expand_no_punct.applymap(lemmatize)
+def lemmatize(x):
+    return ' '.join(map(lemmatize_word, x.split()))
+
+
+@row_local
+def clean2_expand_no_punct_lemmatize(clean2_expand_no_punct):
+    return parallel_applymap(clean2_expand_no_punct, lemmatize)
+
 
+def clean2_variants_line(names, text):
+    res = {'clean2': clean2_line(text)}
+    if 'clean2_no_punct' in names:
+        res['clean2_no_punct'] = rm_punct(res['clean2'])
+    if 'clean2_expand_no_punct' in names or 'clean2_expand_no_punct_lemmatize' in names:
+        res['clean2_expand_no_punct'] = expand_rm_punct(res['clean2'])
+    if 'clean2_expand_no_punct_lemmatize' in names:
+        res['clean2_expand_no_punct_lemmatize'] = lemmatize(res['clean2_expand_no_punct'])
+    return tuple(res[n] for n in names)
 
+
+@fuses('clean2', 'clean2_no_punct', 'clean2_expand_no_punct', 'clean2_expand_no_punct_lemmatize')
+def clean2_variants(raw, names):
+    values = map_unique(partial(clean2_variants_line, tuple(names)), raw.values).ravel()
+
+    res = {}
+    for i, name in enumerate(names):
+        variant = np.empty(len(values), dtype=np.object_)
+        variant[:] = [v[i] for v in values]
+        res[name] = pd.DataFrame(variant.reshape(raw.shape), index=raw.index, columns=raw.columns).infer_objects()
+    return res
+
+
+@row_local
 def num1(raw):
     def cap_ratio(line):
         line = re.sub('\W', '', line)
@@ -180,390 +621,425 @@ def num1(raw):
     return df
 
 
+@lru_cache(maxsize=None)
+def get_sentence_tokenizer(language='english'):
+    """ Punkt tokenizer used by tokenize.sent_tokenize """
+    if hasattr(tokenize, '_get_punkt_tokenizer'):
+        return tokenize._get_punkt_tokenizer(language)
+
+    import nltk.data
+    return nltk.data.load('tokenizers/punkt/%s.pickle' % language)
+
+
+word_pattern = re.compile(r'(?u)\b\w\w+\b')
+
+
+def segment_means(values, counts):
+    """ Means of consecutive segments of values with given lengths, 0 for empty segments """
+    sums = np.bincount(np.repeat(np.arange(len(counts)), counts), weights=values, minlength=len(counts))
+    return np.where(counts > 0, sums / np.maximum(counts, 1), 0)
+
+
+def num2_stats(lines):
+    tokenizer = get_sentence_tokenizer()
+
+    num_sents = np.zeros(len(lines), dtype=np.int64)
+    num_words = np.zeros(len(lines), dtype=np.int64)
+    num_uniq_words = np.zeros(len(lines), dtype=np.int64)
+    sent_lens, sent_num_words, word_lens = [], [], []
+
+    for i, line in enumerate(lines):
+        sent_spans = list(tokenizer.span_tokenize(line))
+        word_matches = list(word_pattern.finditer(line))
+        word_starts = [m.start() for m in word_matches]
+        words = [m.group() for m in word_matches]
+
+        # Sentences are separated by whitespace, so no word crosses their boundaries
+        sent_lens.extend(end - start for start, end in sent_spans)
+        sent_num_words.extend(bisect_left(word_starts, end) - bisect_left(word_starts, start) for start, end in sent_spans)
+        word_lens.extend(map(len, words))
+
+        num_sents[i] = len(sent_spans)
+        num_words[i] = len(words)
+        num_uniq_words[i] = len(set(words))
+
+    return pd.DataFrame(dict(
+        num_sents=num_sents,
+        num_words=num_words,
+        mean_sent_len=segment_means(sent_lens, num_sents),
+        mean_sent_len_words=segment_means(sent_num_words, num_sents),
+        mean_word_len=segment_means(word_lens, num_words),
+        uniq_word_ratio=num_uniq_words / (num_words + 1e-3),
+    ), index=lines.index)
+
+
+@row_local
 def num2(clean2):
-    res = []
-    for line in clean2['comment_text']:
-        sents = tokenize.sent_tokenize(line)
-        words = re.findall(r'(?u)\b\w\w+\b', line)
+    return map_unique_rows(num2_stats, clean2['comment_text'])
+
+
+@lru_cache(maxsize=None)
+def get_sentiment_analyzer():
+    return SentimentIntensityAnalyzer()
+
+
+sentiment_columns = ['neg', 'neu', 'pos', 'compound']
+sentiment_cache_size = int(os.getenv('SENTIMENT_CACHE_SIZE', 2 ** 20))
+
+
+def sentiment_stats(texts, cache={}):
+    """
+    VADER scores of text batch. Scores are cached in process by hash of text with normalized whitespace,
+    which doesn't change the scores as VADER works on whitespace-separated tokens.
+    """
+    analyzer = get_sentiment_analyzer()
+    res = np.zeros((len(texts), len(sentiment_columns)), dtype=np.float32)
 
-        res.append(dict(
-            num_sents=len(sents),
-            num_words=len(words),
-            mean_sent_len=np.mean(list(map(len, sents))) if len(sents) > 0 else 0,
-            mean_sent_len_words=np.mean([len(re.findall(r'(?u)\b\w\w+\b', s)) for s in sents]) if len(sents) > 0 else 0,
-            mean_word_len=np.mean(list(map(len, words))) if len(words) > 0 else 0,
-            uniq_word_ratio=len(set(words)) / (len(words) + 1e-3),
-        ))
+    for i, text in enumerate(texts):
+        key = hashlib.sha1(' '.join(text.split()).encode()).digest()
+        scores = cache.get(key)
+        if scores is None:
+            polarity = analyzer.polarity_scores(text)
+            scores = tuple(polarity[c] for c in sentiment_columns)
 
-    return pd.DataFrame.from_records(res, index=clean2.index)
+            if sentiment_cache_size > 0:
+                if len(cache) >= sentiment_cache_size:
+                    cache.clear()
+                cache[key] = scores
+        res[i] = scores
 
+    return pd.DataFrame(dict(zip(sentiment_columns, res.T)), index=texts.index)
 
+
+@row_local
 def sentiment1(raw):
-    analyzer = SentimentIntensityAnalyzer()
-    res = []
-    for text in raw['comment_text']:
-        res.append(analyzer.polarity_scores(text))
-    return pd.DataFrame.from_records(res, index=raw.index)
+    return map_unique_rows(sentiment_stats, raw['comment_text'])
 
 
-def clean2_bpe50k(clean2):
+@lru_cache(maxsize=None)
+def get_bpe_processor(model_file):
     import sentencepiece as spm
 
     sp = spm.SentencePieceProcessor()
-    sp.Load("input/en.wiki.bpe.op50000.model")
+    sp.Load(model_file)
+    return sp
 
-    def apply_bpe(line):
-        line = re.sub(r'\s+', ' ', line).lower().strip()
-        return ' '.join(sp.EncodeAsPieces(line))
 
-    return clean2.applymap(apply_bpe)
+@lru_cache(maxsize=2 ** 20)
+def bpe_word_pieces(model_file, word):
+    return tuple(get_bpe_processor(model_file).EncodeAsPieces(word))
 
 
-def clean2_bpe25k(clean2):
-    import sentencepiece as spm
+@lru_cache(maxsize=2 ** 20)
+def bpe_word_ids(model_file, word):
+    return tuple(get_bpe_processor(model_file).EncodeAsIds(word))
+
+
+def apply_bpe(model_file, line):
+    if isinstance(line, float):  # skip nan
+        return line
+
+    # Sentencepiece pieces never cross whitespace, so line is encoded word by word with memoized word pieces
+    return ' '.join(piece for word in line.lower().split() for piece in bpe_word_pieces(model_file, word))
+
+
+def apply_bpe_ids(model_file, line):
+    """ Piece ids of line as int32 array, stored by feature store as flat ids plus offsets """
+    if isinstance(line, float):  # skip nan
+        return line
+
+    return np.array([i for word in line.lower().split() for i in bpe_word_ids(model_file, word)], dtype=np.int32)
+
+
+@row_local
+@reads('input/en.wiki.bpe.op50000.model')
+def clean2_bpe50k(clean2):
+    return parallel_applymap(clean2, partial(apply_bpe, "input/en.wiki.bpe.op50000.model"))
 
-    sp = spm.SentencePieceProcessor()
-    sp.Load("input/en.wiki.bpe.op25000.model")
 
-    def apply_bpe(line):
-        line = re.sub(r'\s+', ' ', line).lower().strip()
-        return ' '.join(sp.EncodeAsPieces(line))
+@row_local
+@reads('input/en.wiki.bpe.op50000.model')
+def clean2_bpe50k_ids(clean2):
+    return parallel_applymap(clean2, partial(apply_bpe_ids, "input/en.wiki.bpe.op50000.model"))
 
-    return clean2.applymap(apply_bpe)
+
+@row_local
+@reads('input/en.wiki.bpe.op25000.model')
+def clean2_bpe25k(clean2):
+    return parallel_applymap(clean2, partial(apply_bpe, "input/en.wiki.bpe.op25000.model"))
+
+
+@row_local
+@reads('input/en.wiki.bpe.op25000.model')
+def clean2_bpe25k_ids(clean2):
+    return parallel_applymap(clean2, partial(apply_bpe_ids, "input/en.wiki.bpe.op25000.model"))
 
 
+@row_local
+@reads('input/en.wiki.bpe.op10000.model')
 def clean2_bpe10k(clean2):
-    import sentencepiece as spm
+    return parallel_applymap(clean2, partial(apply_bpe, "input/en.wiki.bpe.op10000.model"))
 
-    sp = spm.SentencePieceProcessor()
-    sp.Load("input/en.wiki.bpe.op10000.model")
 
-    def apply_bpe(line):
-        line = re.sub(r'\s+', ' ', line).lower().strip()
-        return ' '.join(sp.EncodeAsPieces(line))
+@row_local
+@reads('input/en.wiki.bpe.op10000.model')
+def clean2_bpe10k_ids(clean2):
+    return parallel_applymap(clean2, partial(apply_bpe_ids, "input/en.wiki.bpe.op10000.model"))
 
-    return clean2.applymap(apply_bpe)
 
+class Indicators:
+    """
+    Named text indicators computed together in a single call per text.
+    Indicator is either a text -> value function or a regexp, which non-overlapping matches are counted.
+    """
 
-def ind1(raw):
-    text = raw["comment_text"]
-    df = pd.DataFrame(index=raw.index)
+    def __init__(self, indicators):
+        self.names = [name for name, _ in indicators]
+        self.indicators = [re.compile(ind) if isinstance(ind, str) else ind for _, ind in indicators]
 
+    def __call__(self, text):
+        return tuple(len(ind.findall(text)) if hasattr(ind, 'findall') else ind(text) for ind in self.indicators)
+
+    def apply(self, texts):
+        return pd.DataFrame(list(map_unique(self, texts)), index=texts.index, columns=self.names)
+
+
+def count_words(text):
+    return len(text.split())
+
+
+ind1_indicators = Indicators([
     # Count number of \n
-    df["ant_slash_n"] = text.apply(lambda x: count_regexp_occ(r"\n", x))
+    ("ant_slash_n", r"\n"),
     # Get length in words and characters
-    df["raw_word_len"] = text.apply(lambda x: len(x.split()))
-    df["raw_char_len"] = text.apply(lambda x: len(x))
+    ("raw_word_len", count_words),
+    ("raw_char_len", len),
     # Check number of upper case, if you're angry you may write in upper case
-    df["nb_upper"] = text.apply(lambda x: count_regexp_occ(r"[A-Z]", x))
+    ("nb_upper", r"[A-Z]"),
     # Number of F words - f..k contains folk, fork,
-    df["nb_fk"] = text.apply(lambda x: count_regexp_occ(r"[Ff]\S{2}[Kk]", x))
+    ("nb_fk", r"[Ff]\S{2}[Kk]"),
     # Number of S word
-    df["nb_sk"] = text.apply(lambda x: count_regexp_occ(r"[Ss]\S{2}[Kk]", x))
+    ("nb_sk", r"[Ss]\S{2}[Kk]"),
     # Number of D words
-    df["nb_dk"] = text.apply(lambda x: count_regexp_occ(r"[dD]ick", x))
+    ("nb_dk", r"[dD]ick"),
     # Number of occurence of You, insulting someone usually needs someone called : you
-    df["nb_you"] = text.apply(lambda x: count_regexp_occ(r"\W[Yy]ou\W", x))
+    ("nb_you", r"\W[Yy]ou\W"),
     # Just to check you really refered to my mother ;-)
-    df["nb_mother"] = text.apply(lambda x: count_regexp_occ(r"\Wmother\W", x))
+    ("nb_mother", r"\Wmother\W"),
     # Just checking for toxic 19th century vocabulary
-    df["nb_ng"] = text.apply(lambda x: count_regexp_occ(r"\Wnigger\W", x))
+    ("nb_ng", r"\Wnigger\W"),
     # Some Sentences start with a <:> so it may help
-    df["start_with_columns"] = text.apply(lambda x: count_regexp_occ(r"^\:+", x))
+    ("start_with_columns", r"^\:+"),
     # Check for time stamp
-    df["has_timestamp"] = text.apply(lambda x: count_regexp_occ(r"\d{2}|:\d{2}", x))
+    ("has_timestamp", r"\d{2}|:\d{2}"),
     # Check for dates 18:44, 8 December 2010
-    df["has_date_long"] = text.apply(lambda x: count_regexp_occ(r"\D\d{2}:\d{2}, \d{1,2} \w+ \d{4}", x))
+    ("has_date_long", r"\D\d{2}:\d{2}, \d{1,2} \w+ \d{4}"),
     # Check for date short 8 December 2010
-    df["has_date_short"] = text.apply(lambda x: count_regexp_occ(r"\D\d{1,2} \w+ \d{4}", x))
+    ("has_date_short", r"\D\d{1,2} \w+ \d{4}"),
     # Check for http links
-    df["has_http"] = text.apply(lambda x: count_regexp_occ(r"http[s]{0,1}://\S+", x))
+    ("has_http", r"http[s]{0,1}://\S+"),
     # check for mail
-    df["has_mail"] = text.apply(
-        lambda x: count_regexp_occ(r'[a-zA-Z0-9_.+-]+@[a-zA-Z0-9-]+\.[a-zA-Z0-9-.]+', x)
-    )
+    ("has_mail", r'[a-zA-Z0-9_.+-]+@[a-zA-Z0-9-]+\.[a-zA-Z0-9-.]+'),
     # Looking for words surrounded by == word == or """" word """"
-    df["has_emphasize_equal"] = text.apply(lambda x: count_regexp_occ(r"\={2}.+\={2}", x))
-    df["has_emphasize_quotes"] = text.apply(lambda x: count_regexp_occ(r"\"{4}\S+\"{4}", x))
+    ("has_emphasize_equal", r"\={2}.+\={2}"),
+    ("has_emphasize_quotes", r"\"{4}\S+\"{4}"),
+])
 
-    return df
 
+@row_local
+def ind1(raw):
+    return ind1_indicators.apply(raw["comment_text"])
 
-def translate(comment, language):
-    from textblob import TextBlob
-    from textblob.translate import NotTranslated
 
-    if hasattr(comment, "decode"):
-        comment = comment.decode("utf-8")
+translation_languages = ['de', 'fr', 'es']
+translation_backend = os.getenv('TRANSLATION_BACKEND', 'textblob')
 
-    text = TextBlob(comment)
-    try:
-        text = text.translate(to=language)
-        text = text.translate(to="en")
-    except NotTranslated:
-        pass
 
-    return str(text)
+@lru_cache(maxsize=None)
+def get_translator():
+    from src.util.translation import Translator, TranslationCache, backends
+
+    backend = backends[translation_backend]()
+    return Translator(backend, TranslationCache(os.path.join(cache_dir, 'translations.sqlite')))
 
 
+@row_local
+@reads('input/train_de.csv', 'input/train_fr.csv', 'input/train_es.csv')
 def multilang(raw):
+    """ Comments translated to other languages and back, taken from pretranslated files if present """
     df = raw.copy()
-    langs = ['de', 'fr', 'es']
 
-    if False:
-        parallel = Parallel(300, backend="threading", verbose=5)
-        for language in langs:
-            print('Translate comments using "{0}" language'.format(language))
-            df['comment_text__%s' % language] = parallel(delayed(translate)(comment, language) for comment in raw['comment_text'])
-    else:
-        for language in langs:
-            df['comment_text__%s' % language] = pd.read_csv('input/train_%s.csv' % language, index_col='id')['comment_text'].loc[df.index]
+    for language in translation_languages:
+        filename = 'input/train_%s.csv' % language
+        if os.path.exists(filename):
+            df['comment_text__%s' % language] = pd.read_csv(filename, index_col='id')['comment_text'].loc[df.index]
+        else:
+            df['comment_text__%s' % language] = get_translator().translate(list(raw['comment_text']), language)
 
     return df
 
 
-def multilang_clean3(multilang):
-    url_pattern = re.compile(r"""(?i)\b((?:[a-z][\w-]+:(?:/{1,3}|[a-z0-9%])|www\d{0,3}[.]|[a-z0-9.\-]+[.][a-z]{2,4}/)(?:[^\s()<>]+|\(([^\s()<>]+|(\([^\s()<>]+\)))*\))+(?:\(([^\s()<>]+|(\([^\s()<>]+\)))*\)|[^\s`!()\[\]{};:'".,<>?«»“”‘’]))""")
-
-    expand_patterns = [
-        (r'US', 'United States'),
-        (r'IT', 'Information Technology'),
-        (r'(W|w)on\'t', 'will not'),
-        (r'(C|c)an\'t', 'can not'),
-        (r'(I|i)\'m', 'i am'),
-        (r'(A|a)in\'t', 'is not'),
-        (r'(\w+)\'ll', '\g<1> will'),
-        (r'(\w+)n\'t', '\g<1> not'),
-        (r'(\w+)\'ve', '\g<1> have'),
-        (r'(\w+)\'s', '\g<1> is'),
-        (r'(\w+)\'re', '\g<1> are'),
-        (r'(\w+)\'d', '\g<1> would'),
-    ]
-
-    def clean(line):
-        if isinstance(line, float): # skip nan
-            return line
+def clean3_line(line):
+    if isinstance(line, float): # skip nan
+        return line
 
-        line = re.sub(r'[\s\n\t_]+', ' ', ' ' + line.lower() + ' ')  # replace sequence of spacing symbols with single space
-        line = line.replace('\xad', '')
-        line = re.sub(r'\[\d+\]', '', line)  # remove wiki references
-        line = unicodedata.normalize('NFKD', line)  # normalize unicode
-        line = line.encode("ascii", errors="ignore").decode()  # remove non-ascii
+    return expand_rewriter(clean2_rewriter(line))
 
-        line = re.sub(url_pattern, ' urltoken ', line)  # urls
 
-        line = re.sub(r'([0-9a-f]+:+)[0-9a-f]+', ' iptoken ', line)  # ipv6 addresses
-        line = re.sub(r'([0-9]+\.+){2,}[0-9]+', ' iptoken ', line)  # ipv4 addresses
+@row_local
+def multilang_clean3(multilang):
+    return parallel_applymap(multilang, clean3_line)
 
-        line = re.sub(r'(\d)([^\d])', '\\1 \\2', line)  # split 5million
-        line = re.sub(r'([^\d])(\d)', '\\1 \\2', line)  # split wikipedia86
-        line = re.sub(r'\d\d+', '00', line)  # replace big numerics with 00
 
-        line = re.sub(r'(.)\1{2,}', r'\1', line)  # replace identical consecutive characters
+@reads('input/crawl-300d-2M.vec')
+def multilang_clean3_corrected_fasttext(multilang_clean3):
+    return apply_corrections(multilang_clean3, 'input/crawl-300d-2M.vec')
 
-        for pattern, repl in expand_patterns:
-            line = re.sub(pattern, repl, line)
 
-        return line
+url_pattern2 = re.compile(r"""(?i)\b((?:[hf][\w-]{2,3}:(?:/{1,3}|[a-z0-9%])|www\d{0,3}[.]|[a-z0-9.\-]+[.][a-z]{2,4}/)(?:[^\s()<>]+|\(([^\s()<>]+|(\([^\s()<>]+\)))*\))+(?:\(([^\s()<>]+|(\([^\s()<>]+\)))*\)|[^\s`!()\[\]{};:'".,<>?«»“”‘’]))""")
 
-    return multilang.applymap(clean)
+expand_patterns2 = [
+    (r'US', 'United States', ['US']),
+    (r'IT', 'Information Technology', ['IT']),
+    (r'wasn\'?t', 'was not', ['wasn']),
+    (r'you\'?re', 'you are', ['you']),
+    (r'won\'?t', 'will not', ['won']),
+    (r'can\'?t', 'can not', ['can']),
+    (r'i\'?m', 'i am', ['im', "i'm"]),
+    (r'ain\'?t', 'is not', ['ain']),
+    (r'(\w+)\'ll', '\g<1> will', ["'ll"]),
+    (r'(\w+)n\'t', '\g<1> not', ["n't"]),
+    (r'(\w+)\'ve', '\g<1> have', ["'ve"]),
+    (r'(\w+)\'s', '\g<1> is', ["'s"]),
+    (r'(\w+)\'re', '\g<1> are', ["'re"]),
+    (r'(\w+)\'d', '\g<1> would', ["'d"]),
+    (r'\bf[*@$]+k', 'fuck', ['*', '@', '$']),
+    (r'\bsu?[*@$]+', 'suck', ['*', '@', '$']),
+    (r'\bf[*@$]+\b', 'fuck', ['*', '@', '$']),
+    (r'\bf[*@$]+i', 'fucki', ['*', '@', '$']),
+]
 
 
-def multilang_clean3_corrected_fasttext(multilang_clean3):
-    return apply_corrections(multilang_clean3, 'input/crawl-300d-2M.vec')
+clean4_rewriter = Rewriter(
+    str.lower,
+    ('\xad', '', ['\xad']),
+    to_ascii,  # normalize unicode and remove non-ascii
+    (r'\b\w([^\w])\w(\1\w)+\b', join_spelled_word),
 
+    pad,
+    (r'[\s\n\t_]+', ' '),  # replace sequence of spacing symbols with single space
+    (r'\[\d+\]', '', ['[']),  # remove wiki references
+    [(r'user:\w+', ' user ', ['user:']), (r'\[talk\]', ' ', ['[talk]']), (r'\(talk\)', ' ', ['(talk)'])],  # replace user:username, remove talk links
 
-def multilang_clean4(multilang):
-    url_pattern = re.compile(r"""(?i)\b((?:[hf][\w-]{2,3}:(?:/{1,3}|[a-z0-9%])|www\d{0,3}[.]|[a-z0-9.\-]+[.][a-z]{2,4}/)(?:[^\s()<>]+|\(([^\s()<>]+|(\([^\s()<>]+\)))*\))+(?:\(([^\s()<>]+|(\([^\s()<>]+\)))*\)|[^\s`!()\[\]{};:'".,<>?«»“”‘’]))""")
-
-    expand_patterns = [
-        (r'US', 'United States'),
-        (r'IT', 'Information Technology'),
-        (r'wasn\'?t', 'was not'),
-        (r'you\'?re', 'you are'),
-        (r'won\'?t', 'will not'),
-        (r'can\'?t', 'can not'),
-        (r'i\'?m', 'i am'),
-        (r'ain\'?t', 'is not'),
-        (r'(\w+)\'ll', '\g<1> will'),
-        (r'(\w+)n\'t', '\g<1> not'),
-        (r'(\w+)\'ve', '\g<1> have'),
-        (r'(\w+)\'s', '\g<1> is'),
-        (r'(\w+)\'re', '\g<1> are'),
-        (r'(\w+)\'d', '\g<1> would'),
-        (r'\bf[*@$]+k', 'fuck'),
-        (r'\bsu?[*@$]+', 'suck'),
-        (r'\bf[*@$]+\b', 'fuck'),
-        (r'\bf[*@$]+i', 'fucki'),
-    ]
-
-    def clean(line):
-        if isinstance(line, float):  # skip nan
-            return line
+    (url_pattern2, ' url ', [':', 'www', '/']),  # urls
 
-        line = unicodedata.normalize('NFKD', line.lower().replace('\xad', ''))  # normalize unicode
-        line = line.encode("ascii", errors="ignore").decode()  # remove non-ascii
-        line = re.sub(r'\b\w([^\w])\w(\1\w)+\b', lambda m: re.sub('\W', '', m.group()), line)
+    (r'([0-9a-f]+:+)[0-9a-f]+', ' ', [':']),  # ipv6 addresses
+    (r'([0-9]+\.+){2,}[0-9]+', ' ', ['.']),  # ipv4 addresses
 
-        line = re.sub(r'[\s\n\t_]+', ' ', ' ' + line + ' ')  # replace sequence of spacing symbols with single space
-        line = re.sub(r'\[\d+\]', '', line)  # remove wiki references
-        line = re.sub(r'user:\w+', ' user ', line)  # replace user:username
-        line = line.replace('[talk]', ' ').replace('(talk)', ' ')
+    (r'\d+(\s+\d+)*', SpacedNumber('0')),  # split 5million and wikipedia86, replace numerics with 0
 
-        line = re.sub(url_pattern, ' url ', line)  # urls
+    (r'(.)\1{2,}', r'\1'),  # replace identical consecutive characters
 
-        line = re.sub(r'([0-9a-f]+:+)[0-9a-f]+', ' ', line)  # ipv6 addresses
-        line = re.sub(r'([0-9]+\.+){2,}[0-9]+', ' ', line)  # ipv4 addresses
+    *expand_patterns2
+)
 
-        line = re.sub(r'(\d)([^\d])', '\\1 \\2', line)  # split 5million
-        line = re.sub(r'([^\d])(\d)', '\\1 \\2', line)  # split wikipedia86
-        line = re.sub(r'\d+(\s+\d+)*', '0', line)  # replace big numerics with 00
 
-        line = re.sub(r'(.)\1{2,}', r'\1', line)  # replace identical consecutive characters
+def clean4_line(line):
+    if isinstance(line, float):  # skip nan
+        return line
 
-        for pattern, repl in expand_patterns:
-            line = re.sub(pattern, repl, line)
+    return clean4_rewriter(line)
 
-        return line
 
-    return multilang.applymap(clean)
+@row_local
+def multilang_clean4(multilang):
+    return parallel_applymap(multilang, clean4_line)
 
 
-def apply_corrections2(df, vectors):
-    alphabet = string.ascii_lowercase
-    corrector_cache = {}
-
-    fasttext_voc = set(line.split()[0] for line in open(vectors))
-    clean_voc = Counter(w for line in df['comment_text'] for w in re.findall(r'(?u)\b\w\w*\b', line) if w in fasttext_voc)
-
-    def edits1(word):
-        splits = [(word[:i], word[i:]) for i in range(len(word) + 1)]
-        deletes = [a + b[1:] for a, b in splits if b]
-        transposes = [a + b[1] + b[0] + b[2:] for a, b in splits if len(b) > 1]
-        replaces = [a + c + b[1:] for a, b in splits for c in alphabet if b]
-        inserts = [a + c + b for a, b in splits for c in alphabet]
-        return (deletes + transposes + replaces + inserts)
-
-    def correct(word):
-        if word in clean_voc:
-            return [word]
+class Corrector2(Corrector):
 
-        corrs = corrector_cache.get(word)
-        if corrs is not None:
-            return corrs
+    token_pattern = re.compile(r'(?u)\b\w\w*\b')
 
+    def correct_missing(self, word, voc):
         if len(word) < 20:
-            corrs, corr_freq = None, 0
-            for cand in edits1(word):
-                cand_freq = clean_voc.get(cand, 0)
-                if cand_freq > corr_freq:
-                    corrs = [cand]
-                    corr_freq = cand_freq
-
-            if corrs is not None:
-                corrector_cache[word] = corrs
-                return corrs
+            corr, _ = self.best_edit(word, 1, voc)
+            if corr is not None:
+                return [corr]
 
         if len(word) < 15:
-            for precand in edits1(word):
-                for cand in edits1(precand):
-                    cand_freq = clean_voc.get(cand, 0)
-                    if cand_freq > corr_freq:
-                        corrs = [cand]
-                        corr_freq = cand_freq
-
-            if corrs is not None:
-                corrector_cache[word] = corrs
-                return corrs
+            corr, _ = self.best_edit(word, 2, voc)
+            if corr is not None:
+                return [corr]
 
         if len(word) > 4 and len(word) < 50:
             for sz in reversed(range(1, min(len(word) - 1, 10))):
-                if clean_voc.get(word[:sz], 0) > 100:
-                    corrs = [word[:sz]] + correct(word[sz:])
-                    corrector_cache[word] = corrs
-                    return corrs
+                if voc.get(word[:sz]) > 100:
+                    return [word[:sz]] + self.correct_part(word[sz:], voc)
 
         if len(word) > 20:
-            corrector_cache[word] = []
             return []
 
-        corrs = [word]
-        corrector_cache[word] = corrs
-        return corrs
-
-    def correct_line(line):
-        if isinstance(line, float):  # skip nan
-            return line
+        return [word]
 
-        words = re.findall(r'(?u)\b\w\w*\b', line)
-        words = [sw for w in words for sw in correct(w)]
-        return ' '.join(words)
 
-    return df.applymap(correct_line)
+def apply_corrections2(df, vectors):
+    return apply_corrections(df, vectors, Corrector2)
 
 
+@reads('input/crawl-300d-2M.vec')
 def multilang_clean4_corrected_fasttext(multilang_clean4):
     return apply_corrections2(multilang_clean4, 'input/crawl-300d-2M.vec')
 
 
+@reads('input/glove.twitter.27B.200d.txt')
 def multilang_clean4_corrected_twitter(multilang_clean4):
     return apply_corrections2(multilang_clean4, 'input/glove.twitter.27B.200d.txt')
 
 
+@row_local
+@reads('input/en.wiki.bpe.op50000.model')
 def multilang_clean4_bpe50k(multilang_clean4):
-    import sentencepiece as spm
-
-    sp = spm.SentencePieceProcessor()
-    sp.Load("input/en.wiki.bpe.op50000.model")
-
-    def apply_bpe(line):
-        if isinstance(line, float):  # skip nan
-            return line
+    return parallel_applymap(multilang_clean4, partial(apply_bpe, "input/en.wiki.bpe.op50000.model"))
 
-        line = re.sub(r'\s+', ' ', line).lower().strip()
-        return ' '.join(sp.EncodeAsPieces(line))
 
-    return multilang_clean4.applymap(apply_bpe)
+@row_local
+@reads('input/en.wiki.bpe.op50000.model')
+def multilang_clean4_bpe50k_ids(multilang_clean4):
+    return parallel_applymap(multilang_clean4, partial(apply_bpe_ids, "input/en.wiki.bpe.op50000.model"))
 
 
+@row_local
+@reads('input/en.wiki.bpe.op25000.model')
 def multilang_clean4_bpe25k(multilang_clean4):
-    import sentencepiece as spm
-
-    sp = spm.SentencePieceProcessor()
-    sp.Load("input/en.wiki.bpe.op25000.model")
-
-    def apply_bpe(line):
-        if isinstance(line, float):  # skip nan
-            return line
+    return parallel_applymap(multilang_clean4, partial(apply_bpe, "input/en.wiki.bpe.op25000.model"))
 
-        line = re.sub(r'\s+', ' ', line).lower().strip()
-        return ' '.join(sp.EncodeAsPieces(line))
 
-    return multilang_clean4.applymap(apply_bpe)
+@row_local
+@reads('input/en.wiki.bpe.op25000.model')
+def multilang_clean4_bpe25k_ids(multilang_clean4):
+    return parallel_applymap(multilang_clean4, partial(apply_bpe_ids, "input/en.wiki.bpe.op25000.model"))
 
 
+@row_local
+@reads('input/en.wiki.bpe.op10000.model')
 def multilang_clean4_bpe10k(multilang_clean4):
-    import sentencepiece as spm
-
-    sp = spm.SentencePieceProcessor()
-    sp.Load("input/en.wiki.bpe.op10000.model")
-
-    def apply_bpe(line):
-        if isinstance(line, float):  # skip nan
-            return line
+    return parallel_applymap(multilang_clean4, partial(apply_bpe, "input/en.wiki.bpe.op10000.model"))
 
-        line = re.sub(r'\s+', ' ', line).lower().strip()
-        return ' '.join(sp.EncodeAsPieces(line))
 
-    return multilang_clean4.applymap(apply_bpe)
+@row_local
+@reads('input/en.wiki.bpe.op10000.model')
+def multilang_clean4_bpe10k_ids(multilang_clean4):
+    return parallel_applymap(multilang_clean4, partial(apply_bpe_ids, "input/en.wiki.bpe.op10000.model"))
 
 
+@reads('input/train_atanas.csv', 'input/test_atanas.csv')
 def atanas(raw):
     tr = pd.read_csv('input/train_atanas.csv', index_col='id')[['comment_text']]
     te = pd.read_csv('input/test_atanas.csv', index_col='id')
     return pd.concat([tr, te]).fillna('').loc[raw.index]
 
 
+@reads('input/meta_train_from_api.csv', 'input/meta_test_from_api.csv')
 def api1(raw):
     data = pd.concat((pd.read_csv('input/meta_train_from_api.csv'), pd.read_csv('input/meta_test_from_api.csv')))
     data.drop(['text'], axis=1, inplace=True)
@@ -572,159 +1048,53 @@ def api1(raw):
 
 
 def api2_raw(raw):
-    from googleapiclient import discovery
-
-    tls = threading.local()
-    eos_pattern = re.compile(r"[!?.]\s+")
-    eow_pattern = re.compile(r"\s+")
-
-    def aggregate_api_responses(responses):
-        if any(r is None for r in responses):
-            return None
-
-        keys = ['UNSUBSTANTIAL', 'LIKELY_TO_REJECT', 'OBSCENE', 'SEVERE_TOXICITY', 'TOXICITY', 'INFLAMMATORY', 'SPAM', 'ATTACK_ON_AUTHOR', 'INCOHERENT', 'ATTACK_ON_COMMENTER']
-        res = {}
-
-        for k in keys:
-            vals = [r[k] for r in responses]
-            res[k] = {
-                'spanScores': sum([v['spanScores'] for v in vals], []),
-                'summaryScore': {'type': 'PROBABILITY', 'value': (sum(v['summaryScore']['value'] for v in vals) / len(vals))},
-                'parts': vals
-            }
+    from src.util.perspective import analyze_comments
+
+    log_file = 'tmp/api2_responses.jsonl'
+    if os.path.exists('tmp/state.pickle') and not os.path.exists(log_file):  # Resume from state of old client
+        state = pd.read_pickle('tmp/state.pickle')['api_response'].dropna()
+        with open(log_file, 'w') as f:
+            for idx, resp in state.items():
+                f.write(json.dumps(dict(id=str(idx), response=resp)) + '\n')
+
+    responses = analyze_comments(
+        raw['comment_text'], log_file, api_key=os.getenv('API_KEY'),
+        rate=float(os.getenv('API_RATE', '10')), concurrency=int(os.getenv('API_CONCURRENCY', '20'))
+    )
 
-        return res
+    return pd.DataFrame({'api_response': responses}, index=raw.index)
 
-    def split_text(text, min_len, max_len):
-        parts = []
-
-        pos = 0
-        while len(text) - pos > max_len:
-            split_match = eos_pattern.search(text, pos + min_len, pos + max_len)
-            if split_match is None:
-                split_match = eow_pattern.search(text, pos + min_len, pos + max_len)
-            if split_match is None:
-                split_pos = pos + min_len
-            else:
-                split_pos = split_match.end()
-            parts.append(text[pos:split_pos])
-            pos = split_pos
-
-        parts.append(text[pos:])
-        return parts
-
-    def get_api_response(text):
-        if len(text) > 2900:
-            return aggregate_api_responses([get_api_response(p) for p in split_text(text, 2000, 2900)])
-
-        analyze_request = {
-            'comment': {'text': text},
-            'requestedAttributes': {
-                'TOXICITY': {},
-                'SEVERE_TOXICITY': {},
-                'ATTACK_ON_AUTHOR': {},
-                'ATTACK_ON_COMMENTER': {},
-                'INCOHERENT': {},
-                'INFLAMMATORY': {},
-                'LIKELY_TO_REJECT': {},
-                'OBSCENE': {},
-                'SPAM': {},
-                'UNSUBSTANTIAL': {}
-            }
-        }
-
-        try:
-            if not hasattr(tls, 'service'):
-                tls.service = discovery.build('commentanalyzer', 'v1alpha1', developerKey=os.getenv('API_KEY'))
-
-            time.sleep(1.0)
-            response = tls.service.comments().analyze(body=analyze_request).execute()
-            return response['attributeScores']
-        except Exception as e:
-            print(e)
-            return None
-
-    with Parallel(10, backend="threading", verbose=5) as parallel:
-        if os.path.exists('tmp/state.pickle'):
-            df = pd.read_pickle('tmp/state.pickle')
-        else:
-            df = pd.DataFrame(index=raw.index)
-            df['api_response'] = None
 
-        index = df[df['api_response'].isnull()].index
+def api_features(scores, index, stats):
+    values = scores.stats()
+    values['max'] = values['min']  # Was computed as min from the start, models are trained with it
 
-        batch_size = 5000
-        for ofs in range(0, len(index), batch_size):
-            idx = index[ofs:ofs+batch_size]
-            df.loc[idx, 'api_response'] = parallel(delayed(get_api_response, check_pickle=False)(comment) for comment in raw.loc[idx, 'comment_text'])
-            df.to_pickle('tmp/state.pickle')
-            print("Saved state on step %d" % ofs)
+    columns = {}
+    for j, k in enumerate(scores.attributes):
+        for stat in stats:
+            columns['%s_%s' % (k, stat)] = values[stat][:, j]
 
-    return df
+    return pd.DataFrame(columns, index=index, columns=list(columns))
 
 
 def api2(api2_raw):
-    def extract_features(resp):
-        if resp is None:
-            return {}
-
-        res = {}
-        for k in resp.keys():
-            res['%s_summary' % k] = resp[k]['summaryScore']['value']
-            res['%s_min' % k] = min(span['score']['value'] for span in resp[k]['spanScores'])
-            res['%s_max' % k] = min(span['score']['value'] for span in resp[k]['spanScores'])
-            res['%s_mean' % k] = np.mean([span['score']['value'] for span in resp[k]['spanScores']])
-            res['%s_std' % k] = np.std([span['score']['value'] for span in resp[k]['spanScores']])
+    from src.util.perspective import ApiScores
 
-        return res
+    return api_features(ApiScores(api2_raw['api_response'].values), api2_raw.index, ['summary', 'min', 'max', 'mean', 'std'])
 
-    records = []
-    for resp in api2_raw['api_response']:
-        records.append(extract_features(resp))
 
-    return pd.DataFrame.from_records(records, index=api2_raw.index)
+@lru_cache(maxsize=None)
+def load_api3_scores():
+    from src.util.perspective import ApiScores
 
+    return ApiScores([line[1] for filename in ['input/new_train_api.pickle', 'input/new_test_api.pickle'] for line in pd.read_pickle(filename)])
 
 
+@reads('input/new_train_api.pickle', 'input/new_test_api.pickle')
 def api3(raw):
-    def extract_features(resp):
-        if isinstance(resp, str):
-            return {}
-
-        res = {}
-        for k in resp.keys():
-            res['%s_summary' % k] = resp[k]['summaryScore']['value']
-            res['%s_min' % k] = min(span['score']['value'] for span in resp[k]['spanScores'])
-            res['%s_max' % k] = min(span['score']['value'] for span in resp[k]['spanScores'])
-
-        return res
-
-    records = []
-    for filename in ['input/new_train_api.pickle', 'input/new_test_api.pickle']:
-        for line in pd.read_pickle(filename):
-            records.append(extract_features(line[1]))
-
-    return pd.DataFrame.from_records(records, index=raw.index)
+    return api_features(load_api3_scores(), raw.index, ['summary', 'min', 'max'])
 
 
+@reads('input/new_train_api.pickle', 'input/new_test_api.pickle')
 def api3_2(raw):
-    def extract_features(resp):
-        if isinstance(resp, str):
-            return {}
-
-        res = {}
-        for k in resp.keys():
-            res['%s_summary' % k] = resp[k]['summaryScore']['value']
-            res['%s_min' % k] = min(span['score']['value'] for span in resp[k]['spanScores'])
-            res['%s_max' % k] = min(span['score']['value'] for span in resp[k]['spanScores'])
-            res['%s_mean' % k] = np.mean([span['score']['value'] for span in resp[k]['spanScores']])
-            res['%s_std' % k] = np.std([span['score']['value'] for span in resp[k]['spanScores']])
-
-        return res
-
-    records = []
-    for filename in ['input/new_train_api.pickle', 'input/new_test_api.pickle']:
-        for line in pd.read_pickle(filename):
-            records.append(extract_features(line[1]))
-
-    return pd.DataFrame.from_records(records, index=raw.index)
+    return api_features(load_api3_scores(), raw.index, ['summary', 'min', 'max', 'mean', 'std'])
@@ -1,14 +1,23 @@
 import os
+import re
+import json
+import hashlib
 import inspect
+import importlib
 import pandas as pd
 
+from functools import partial
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
 from sklearn.model_selection import KFold
 
 from src import features
+from src.util.feature_store import FeatureStore
 
 
 input_dir = os.getenv('INPUT_DIR', 'input')
 cache_dir = os.getenv('CACHE_DIR', 'cache')
+feature_jobs = int(os.getenv('FEATURE_JOBS', '1'))
+trust_legacy_features = os.getenv('TRUST_LEGACY_FEATURES', '1') != '0'
 
 input_columns = ['comment_text']
 target_columns = ['toxic', 'severe_toxic', 'obscene', 'threat', 'insult', 'identity_hate']
@@ -16,16 +25,23 @@ target_columns = ['toxic', 'severe_toxic', 'obscene', 'threat', 'insult', 'ident
 
 cv = KFold(10, shuffle=True, random_state=43)
 
+feature_store = FeatureStore(os.path.join(cache_dir, 'features'))
+
 
 def input_file(filename):
     return os.path.join(input_dir, filename)
 
 
-def get_input_data(preset=None):
-    print("Loading data...")
-
+def read_input_files():
     train = pd.read_csv(input_file('train.csv'), index_col='id')
     test = pd.read_csv(input_file('test.csv'), index_col='id')
+    return train, test
+
+
+def get_input_data(preset=None, n_jobs=None):
+    print("Loading data...")
+
+    train, test = read_input_files()
 
     train_X = train[input_columns]
     train_y = train[target_columns]
@@ -35,8 +51,12 @@ def get_input_data(preset=None):
     del train, test
 
     if hasattr(preset, 'features'):
+        feature_columns = getattr(preset, 'feature_columns', {})
+
         loaded = {'raw': pd.concat((train_X, test_X))}
-        all_X = pd.concat([get_feature(n, loaded) for n in preset.features], axis=1)
+        compute_features(preset.features, loaded, n_jobs=n_jobs, columns=feature_columns)
+
+        all_X = pd.concat([get_feature(n, loaded, feature_columns.get(n)) for n in preset.features], axis=1)
 
         train_X = all_X.loc[train_X.index]
         test_X = all_X.loc[test_X.index]
@@ -44,27 +64,387 @@ def get_input_data(preset=None):
     return train_X, train_y, test_X
 
 
-def get_feature(name, loaded={}):
+def get_feature(name, loaded={}, columns=None, fuse_with=()):
     if name in loaded:
-        return loaded[name]
+        return loaded[name] if columns is None else loaded[name][columns]
+
+    fingerprint = get_feature_fingerprint(name)
 
-    cache_file_path = os.path.join(cache_dir, 'features', name + '.pickle')
-    if os.path.exists(cache_file_path):
-        loaded[name] = pd.read_pickle(cache_file_path)
-        return loaded[name]
+    if feature_store.exists(name):
+        if is_fingerprint_valid(feature_store.read_meta(name), fingerprint):
+            stale_index = get_stale_rows(name, loaded)
+            if len(stale_index) > 0:
+                print("Computing feature %r for %d new or changed rows..." % (name, len(stale_index)))
+                feature_fn = getattr(features, name)
+                dep_names = inspect.getargspec(feature_fn).args
 
-    print("Computing feature %r..." % name)
-    feature_fn = getattr(features, name)
-    dep_names = inspect.getargspec(feature_fn).args
+                new_res = feature_fn(*[get_feature(d, loaded).loc[stale_index] for d in dep_names])
+                feature_store.update(name, new_res, row_hashes=get_row_hashes(loaded['raw']).loc[new_res.index].values, **get_fingerprint_meta(feature_store.read_meta(name)))
 
-    res = feature_fn(*[get_feature(d, loaded) for d in dep_names])
+            res = feature_store.load(name, columns)
+            if columns is None:
+                loaded[name] = res
+            return res
 
-    if not os.path.exists(os.path.join(cache_dir, 'features')):
-        os.makedirs(os.path.join(cache_dir, 'features'))
+        print("Feature %r is stale, recomputing..." % name)
+
+    legacy_cache_file_path = os.path.join(cache_dir, 'features', name + '.pickle')
+    if os.path.exists(legacy_cache_file_path) and trust_legacy_features:
+        print("Converting cached feature %r to columnar format..." % name)
+        res = pd.read_pickle(legacy_cache_file_path)
+        feature_store.save(name, res, fingerprint='legacy', legacy_fingerprint=fingerprint)
+        os.remove(legacy_cache_file_path)
+    elif len(get_fused_names(name, loaded, fuse_with)) > 1:
+        res = compute_fused_features(name, loaded, fuse_with)
+    else:
+        print("Computing feature %r..." % name)
+        feature_fn = getattr(features, name)
+        dep_names = inspect.getargspec(feature_fn).args
+
+        res = feature_fn(*[get_feature(d, loaded) for d in dep_names])
+        feature_store.save(name, res, row_hashes=get_result_row_hashes(name, res, loaded), fingerprint=fingerprint)
 
-    res.to_pickle(cache_file_path)
     loaded[name] = res
-    return res
+    return res if columns is None else res[columns]
+
+
+def get_fused_fn(name):
+    for value in vars(features).values():
+        if name in getattr(value, 'fused_names', ()):
+            return value
+
+
+def get_fused_names(name, loaded, fuse_with):
+    """ Features to compute together with the given one in a single pass: the wanted ones of its fused group which aren't cached yet """
+    fused_fn = get_fused_fn(name)
+    if fused_fn is None:
+        return [name]
+
+    return [n for n in fused_fn.fused_names if n == name or (n in fuse_with and n not in loaded and not is_feature_cached(n, loaded))]
+
+
+def compute_fused_features(name, loaded, fuse_with):
+    fused_fn = get_fused_fn(name)
+    names = get_fused_names(name, loaded, fuse_with)
+
+    print("Computing features %s in one pass..." % ', '.join(map(repr, names)))
+    dep_names = inspect.getargspec(fused_fn).args[:-1]
+
+    results = fused_fn(*[get_feature(d, loaded) for d in dep_names], names)
+    for n in names:
+        feature_store.save(n, results[n], row_hashes=get_result_row_hashes(n, results[n], loaded), fingerprint=get_feature_fingerprint(n))
+        loaded[n] = results[n]
+
+    return results[name]
+
+
+def is_fingerprint_valid(stored_meta, fingerprint):
+    """
+    Check if stored feature is the result of current code. Converted legacy pickles carry no fingerprint of their own
+    and are marked as legacy: they are trusted only while code is the same as at conversion and TRUST_LEGACY_FEATURES isn't 0.
+    """
+    if stored_meta.get('fingerprint') == 'legacy':
+        return trust_legacy_features and stored_meta.get('legacy_fingerprint') == fingerprint
+    return stored_meta.get('fingerprint') == fingerprint
+
+
+def get_fingerprint_meta(stored_meta):
+    return {k: stored_meta[k] for k in ['fingerprint', 'legacy_fingerprint'] if k in stored_meta}
+
+
+def is_feature_cached(name, loaded={}):
+    if feature_store.exists(name):
+        return is_fingerprint_valid(feature_store.read_meta(name), get_feature_fingerprint(name)) and len(get_stale_rows(name, loaded)) == 0
+    else:
+        return trust_legacy_features and os.path.exists(os.path.join(cache_dir, 'features', name + '.pickle'))
+
+
+def get_stale_rows(name, loaded):
+    """
+    Ids of raw rows which are absent from the stored row-local feature or which input changed since it was computed
+    (by stored hashes of input rows). Other features are always recomputed as a whole.
+    """
+    if 'raw' not in loaded or not getattr(getattr(features, name), 'row_local', False):
+        return pd.Index([])
+
+    raw_hashes = get_row_hashes(loaded['raw'])
+    stored_hashes = feature_store.load_row_hashes(name)
+    stored_index = feature_store.load_index(name)
+
+    stale = ~raw_hashes.index.isin(stored_index)
+    if stored_hashes is None:
+        if feature_store.read_meta(name).get('fingerprint') == 'legacy':
+            return raw_hashes.index[stale]  # Rows of trusted legacy features are taken as is
+        return raw_hashes.index  # Rows computed without hashes can't be checked
+
+    stored_hashes = pd.Series(stored_hashes, index=stored_index)
+    stored_hashes = stored_hashes[~stored_hashes.index.duplicated(keep='last')]
+
+    stale[~stale] = stored_hashes.loc[raw_hashes.index[~stale]].values != raw_hashes.values[~stale]
+    return raw_hashes.index[stale]
+
+
+def get_row_hashes(raw, memo={}):
+    """ Content hashes of raw input rows, by row id """
+    if memo.get('raw') is not raw:
+        memo['raw'] = raw
+        memo['hashes'] = pd.Series(pd.util.hash_pandas_object(raw, index=False).values, index=raw.index)
+    return memo['hashes']
+
+
+def get_result_row_hashes(name, res, loaded):
+    if 'raw' not in loaded or not getattr(getattr(features, name), 'row_local', False):
+        return None
+
+    hashes = get_row_hashes(loaded['raw'])
+    if not res.index.isin(hashes.index).all():
+        return None
+    return hashes.loc[res.index].values
+
+
+def compute_features(names, loaded={}, n_jobs=None, columns={}):
+    """
+    Compute all missing features of the dependency graph, running independent ones in parallel processes.
+    Cached features aren't loaded here, so callers can load them projected to the columns they use.
+    """
+    n_jobs = n_jobs or feature_jobs
+
+    pending = {}  # Feature name -> names of its dependencies still to be computed
+
+    def visit(name):
+        if name in pending:
+            return True
+        if name in loaded or is_feature_cached(name, loaded):
+            return False
+
+        dep_names = inspect.getargspec(getattr(features, name)).args
+        pending[name] = set(d for d in dep_names if visit(d))
+        return True
+
+    for name in names:
+        visit(name)
+
+    if len(pending) == 0:
+        return
+
+    if n_jobs <= 1:
+        for name in names:
+            if name in pending:  # Cached features are loaded later, projected to columns they are used with
+                get_feature(name, loaded, columns.get(name), fuse_with=list(pending))
+        return
+
+    for name in pending:
+        get_feature_fingerprint(name)  # Hash input files once, before forking workers
+
+    print("Computing features %s using %d workers..." % (', '.join(map(repr, pending)), n_jobs))
+
+    fused = list(pending)  # Features of fused groups computed in the same pass
+
+    with ProcessPoolExecutor(n_jobs) as executor:
+        running = {}
+
+        while len(pending) > 0 or len(running) > 0:
+            for name in [n for n, deps in pending.items() if len(deps) == 0]:
+                del pending[name]
+                running[executor.submit(_compute_feature_worker, name, max(1, features.map_jobs // n_jobs), fused)] = name
+
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                name = running.pop(future)
+                future.result()
+
+                print("Feature %r is ready" % name)
+                for deps in pending.values():
+                    deps.discard(name)
+
+
+_worker_raw = None
+
+
+def _compute_feature_worker(name, map_jobs, fuse_with=()):
+    global _worker_raw
+
+    features.map_jobs = map_jobs  # Share cores between concurrently computed features
+
+    if _worker_raw is None:
+        train, test = read_input_files()
+        _worker_raw = pd.concat((train[input_columns], test[input_columns]))
+
+    get_feature(name, {'raw': _worker_raw}, fuse_with=fuse_with)  # Result is saved to the feature store, dependencies are read from it
+
+
+def get_feature_fingerprint(name, fingerprints={}):
+    """ Hash of feature code, its dependencies fingerprints and its input files contents """
+    if name in fingerprints:
+        return fingerprints[name]
+
+    h = hashlib.sha1()
+
+    if name == 'raw':
+        for filename in [input_file('train.csv'), input_file('test.csv')]:
+            h.update(get_file_hash(filename).encode())
+    else:
+        feature_fn = getattr(features, name)
+        h.update(get_code_fingerprint(feature_fn).encode())
+
+        # Row-local features are updated for new and changed rows (found by stored row hashes) instead of being invalidated by input changes
+        if not getattr(feature_fn, 'row_local', False):
+            h.update(get_feature_fingerprint('raw', fingerprints).encode())
+
+        for dep_name in inspect.getargspec(feature_fn).args:
+            if dep_name != 'raw':
+                h.update(get_feature_fingerprint(dep_name, fingerprints).encode())
+
+        for filename in getattr(feature_fn, 'input_files', []):
+            h.update((get_file_hash(filename) if os.path.exists(filename) else 'missing').encode())
+
+        # Stored values may come from the fused function instead, so its code is a part of every fused feature's fingerprint
+        fused_fn = get_fused_fn(name)
+        if fused_fn is not None:
+            h.update(get_code_fingerprint(fused_fn).encode())
+            for dep_name in inspect.getargspec(fused_fn).args[:-1]:
+                if dep_name != 'raw':
+                    h.update(get_feature_fingerprint(dep_name, fingerprints).encode())
+
+    fingerprints[name] = h.hexdigest()
+    return fingerprints[name]
+
+
+def get_code_fingerprint(fn):
+    """
+    Hash of function source together with sources of all features module helpers and constants it uses,
+    and whole sources of other src modules they refer to (like src.util helpers and their own src imports)
+    """
+    h = hashlib.sha1()
+    seen = set()
+    seen_modules = set()
+    queue = [fn]
+
+    while len(queue) > 0:
+        obj = queue.pop(0)
+
+        if inspect.ismodule(obj):
+            if obj.__name__ in seen_modules:
+                continue
+            seen_modules.add(obj.__name__)
+
+            h.update(('module %s\n' % obj.__name__).encode())
+            h.update(inspect.getsource(obj).encode())
+            queue.extend(m for m in map(_get_src_module, vars(obj).values()) if m is not None)
+            continue
+
+        h.update(inspect.getsource(obj).encode())
+
+        if inspect.isclass(obj):  # Inherited methods aren't referenced by name
+            for base in obj.__bases__:
+                if base.__module__ == features.__name__ and base.__name__ not in seen:
+                    seen.add(base.__name__)
+                    queue.append(base)
+                elif _get_src_module(base) is not None:
+                    queue.append(_get_src_module(base))
+
+        for ref_name in sorted(_referenced_names(obj)):
+            if ref_name.startswith('src.'):  # Module imported inside function
+                queue.append(importlib.import_module(ref_name))
+                continue
+
+            if ref_name in seen or not hasattr(features, ref_name) or ref_name in features.runtime_settings:
+                continue
+            seen.add(ref_name)
+
+            value = getattr(features, ref_name)
+            if inspect.isfunction(value) or inspect.isclass(value):
+                if value.__module__ == features.__name__ and value is not obj:
+                    queue.append(value)
+                elif _get_src_module(value) is not None:
+                    queue.append(_get_src_module(value))
+            else:
+                h.update(('%s=%s' % (ref_name, _describe_value(value, queue))).encode())
+
+    return h.hexdigest()
+
+
+def _get_src_module(value):
+    """ Module of src package (other than features) which value is or comes from """
+    if inspect.ismodule(value):
+        name = value.__name__
+    elif inspect.isfunction(value) or inspect.isclass(value):
+        name = value.__module__
+    else:
+        name = type(value).__module__
+
+    if name is not None and name.startswith('src.') and name != features.__name__:
+        return importlib.import_module(name)
+
+
+def _describe_value(value, queue):
+    """ Stable description of module-level value, enqueueing features module code and other src modules it refers to """
+    if inspect.isfunction(value) or inspect.isclass(value):
+        if value.__module__ == features.__name__:
+            queue.append(value)
+        elif _get_src_module(value) is not None:
+            queue.append(_get_src_module(value))
+        return '%s.%s' % (value.__module__, value.__qualname__)
+    if isinstance(value, type(re.compile(''))):
+        return '%r/%d' % (value.pattern, value.flags)
+    if isinstance(value, (str, bytes, int, float, bool, type(None))):
+        return repr(value)
+    if isinstance(value, (tuple, list)):
+        return '[%s]' % ', '.join(_describe_value(v, queue) for v in value)
+    if isinstance(value, (set, frozenset)):
+        return 'set(%s)' % ', '.join(sorted(_describe_value(v, queue) for v in value))
+    if isinstance(value, dict):
+        return '{%s}' % ', '.join('%r: %s' % (k, _describe_value(v, queue)) for k, v in sorted(value.items(), key=lambda kv: repr(kv[0])))
+    if hasattr(value, '__wrapped__'):  # lru_cache and other functools wrappers
+        return _describe_value(value.__wrapped__, queue)
+    if isinstance(value, partial):
+        return 'partial(%s)' % _describe_value((value.func, value.args, value.keywords), queue)
+    if type(value).__module__ == features.__name__:
+        return '%s(%s)' % (_describe_value(type(value), queue), _describe_value(vars(value), queue))
+    if _get_src_module(value) is not None:
+        queue.append(_get_src_module(value))
+        return '%s(%s)' % (_describe_value(type(value), queue), _describe_value(vars(value), queue))
+    return type(value).__name__
+
+
+def _referenced_names(obj):
+    if inspect.isclass(obj):
+        return set(n for member in vars(obj).values() if inspect.isfunction(member) for n in _referenced_names(member))
+
+    names = set()
+    codes = [obj.__code__]
+    while len(codes) > 0:
+        code = codes.pop()
+        names.update(code.co_names)
+        codes.extend(c for c in code.co_consts if inspect.iscode(c))
+    return names
+
+
+def get_file_hash(filename):
+    """ Content hash of input file, cached by file size and modification time """
+    hashes_file = os.path.join(cache_dir, 'file_hashes.json')
+    hashes = json.load(open(hashes_file)) if os.path.exists(hashes_file) else {}
+
+    stat = os.stat(filename)
+    key = '%s:%d:%d' % (os.path.abspath(filename), stat.st_size, stat.st_mtime_ns)
+
+    if key not in hashes:
+        print("Hashing %r..." % filename)
+
+        h = hashlib.sha1()
+        with open(filename, 'rb') as f:
+            for chunk in iter(lambda: f.read(1 << 24), b''):
+                h.update(chunk)
+
+        hashes[key] = h.hexdigest()
+
+        if not os.path.exists(cache_dir):
+            os.makedirs(cache_dir)
+        with open(hashes_file + '.%d' % os.getpid(), 'w') as f:
+            json.dump(hashes, f, indent=2)
+        os.replace(hashes_file + '.%d' % os.getpid(), hashes_file)
+
+    return hashes[key]
 
 
 def get_model_prediction(preset, fold, part):
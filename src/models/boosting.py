@@ -96,10 +96,15 @@ class LgbModel:
         self.rounds = {**self.default_rounds, **rounds}
         self.verbose_eval = verbose_eval
 
-    def fit_eval(self, train_X, train_y, eval_X, eval_y):
+    def fit_eval(self, train_X, train_y, eval_X, eval_y, train_idx=None):
+        """ Fit a model per label, on train rows at `train_idx` positions (possibly repeated) if given """
         self.label_columns = list(train_y.columns)
         self.label_models = {}
 
+        # Bag rows are copied rather than taken with Dataset.subset, which would keep feature bins of the whole train set
+        if train_idx is not None:
+            train_X, train_y = train_X.iloc[train_idx], train_y.iloc[train_idx]
+
         for label in self.label_columns:
             print("Training model for %s..." % label)
             dtrain = lgb.Dataset(train_X, label=train_y[label])
@@ -145,13 +150,16 @@ class XgbModel:
         self.rounds = {**self.default_rounds, **rounds}
         self.verbose_eval = verbose_eval
 
-    def fit_eval(self, train_X, train_y, eval_X, eval_y):
+    def fit_eval(self, train_X, train_y, eval_X, eval_y, train_idx=None):
+        """ Fit a model per label, on train rows at `train_idx` positions (possibly repeated) if given """
         self.label_columns = list(train_y.columns)
         self.label_models = {}
 
         for label in self.label_columns:
             print("Training model for %s..." % label)
             dtrain = xgb.DMatrix(train_X, label=train_y[label])
+            if train_idx is not None:
+                dtrain = dtrain.slice(train_idx)  # Same rows in the same order as DMatrix of the bag, built without copying the frame
             dvalid = xgb.DMatrix(eval_X, label=eval_y[label])
 
             self.label_models[label] = xgb.train(self.params, dtrain, self.rounds[label], [(dtrain, 'train'), (dvalid, 'valid')], verbose_eval=self.verbose_eval)
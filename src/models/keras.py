@@ -4,10 +4,18 @@ from keras.optimizers import Adam
 from keras import regularizers
 
 from kgutil.models.keras.base import DefaultTrainSequence, DefaultTestSequence
-from kgutil.models.keras.rnn import KerasRNN, load_emb_matrix
+from kgutil.models.keras.rnn import KerasRNN
+
+from src.util.embeddings import load_emb_matrix
+from src.util.prefetch import BatchPrefetcher
+from src.util.token_ids import TokenIdTransform, TokenizedFrames
 
 from copy import deepcopy
+from functools import partial
+import numpy as np
+import threading
 import inspect
+import random
 
 
 def cudnn_lstm_1(
@@ -494,11 +502,40 @@ def stack3(data, target_shape, l2=1e-3, hid_dropout=None, hid_size=16, shared=Tr
     return Model(inp, out)
 
 
-class AugTrainSequence(DefaultTrainSequence):
+def uses_token_ids(augmentations):
+    return any(getattr(aug, 'token_ids', False) for aug in augmentations)
+
 
-    def __init__(self, augmentations=[], *args, **kwargs):
+class AugTrainSequence(DefaultTrainSequence):
+    """
+    Train sequence applying augmentations to every batch.
+    If some of them work on token ids (like RandomCropIds), texts are tokenized on creation (once per frame,
+    see TokenizedFrames), and batches are padded from id arrays without going through the tokenizer (see TokenIdTransform).
+
+    With `prefetch_workers` > 0 batches are prepared ahead by that many processes, keeping up to `prefetch_depth`
+    of them in shared memory. Index idx of an epoch is served by batch order[idx] of a shuffled order drawn for
+    the epoch from sequence seed, batches are prefetched in that order, so keras enqueuer requesting indices
+    in order gets them ready. Random state is seeded for every batch from sequence seed, epoch and batch index,
+    so augmentations don't depend on the number of workers or on the order of requests.
+    Workers are started with a pickled copy of the sequence on the first request of every epoch.
+    """
+
+    def __init__(self, augmentations=[], prefetch_workers=0, prefetch_depth=8, tokenized_frames=None, *args, **kwargs):
         super().__init__(*args, **kwargs)
+        self.prefetch_workers = prefetch_workers
+        self.prefetch_depth = prefetch_depth
+        self.prefetcher = None
+        self.prefetch_lock = threading.Lock()
+        self.seed = np.random.randint(2 ** 31) if prefetch_workers > 0 else None
+        self.epoch = 0
+
         self.augmentations = [deepcopy(aug) for aug in augmentations]
+        self.token_ids = uses_token_ids(self.augmentations)
+        if self.token_ids:
+            # Unbound base transform, pickled bound super() method would resolve to the override
+            self.token_id_transform = TokenIdTransform(self.data_transformer, partial(DefaultTrainSequence._transform_batch, self), self.X, self.y)
+            self.X = (tokenized_frames or TokenizedFrames()).get(self.data_transformer.text_tokenizer, self.X)
+
         for aug in self.augmentations:
             if hasattr(aug, 'fit'):
                 aug.fit(self.X, self.y)
@@ -510,18 +547,82 @@ class AugTrainSequence(DefaultTrainSequence):
             else:
                 batch_x = aug.transform(batch_x)
 
+        if self.token_ids:
+            return self.token_id_transform(batch_x, batch_y)
+
         return super()._transform_batch(batch_x, batch_y)
 
+    def __getitem__(self, idx):
+        if self.prefetch_workers <= 0:
+            return super().__getitem__(idx)
+
+        with self.prefetch_lock:
+            if self.prefetcher is not None and self.prefetcher.remaining == 0:  # All batches served without epoch end
+                self._close_prefetcher()
+                self.epoch += 1
+
+            if self.prefetcher is None:
+                order = np.random.RandomState((self.seed + self.epoch) % 2 ** 32).permutation(len(self))
+                self.prefetcher = BatchPrefetcher(self._get_seeded_batch, order, self.prefetch_workers, self.prefetch_depth)
+
+            return self.prefetcher.get(idx)
+
+    def on_epoch_end(self):
+        with self.prefetch_lock:
+            self._close_prefetcher()
+
+        super().on_epoch_end()
+        self.epoch += 1
+
+    def _get_seeded_batch(self, idx):
+        np_state, py_state = np.random.get_state(), random.getstate()
+
+        seed = (self.seed + self.epoch * len(self) + idx) % 2 ** 32
+        np.random.seed(seed)
+        random.seed(seed)
+        try:
+            return super().__getitem__(idx)
+        finally:
+            np.random.set_state(np_state)
+            random.setstate(py_state)
+
+    def _close_prefetcher(self):
+        if self.prefetcher is not None:
+            self.prefetcher.close()
+            self.prefetcher = None
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state['prefetcher'], state['prefetch_lock']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.prefetcher = None
+        self.prefetch_lock = threading.Lock()
+
+    def __del__(self):
+        if getattr(self, 'prefetcher', None) is not None:
+            self.prefetcher.close()
+
 
 class AugTestSequence(DefaultTestSequence):
 
-    def __init__(self, augmentations=[], *args, **kwargs):
+    def __init__(self, augmentations=[], tokenized_frames=None, *args, **kwargs):
         super().__init__(*args, **kwargs)
         self.augmentations = augmentations
+        self.token_ids = uses_token_ids(self.augmentations)
+        if self.token_ids:
+            self.token_id_transform = TokenIdTransform(self.data_transformer, super()._transform_batch, self.X)
+            self.X = (tokenized_frames or TokenizedFrames()).get(self.data_transformer.text_tokenizer, self.X)
 
     def _transform_batch(self, batch_x):
         for aug in self.augmentations:
             batch_x = aug.transform(batch_x)
+
+        if self.token_ids:
+            return self.token_id_transform(batch_x)
+
         return super()._transform_batch(batch_x)
 
 
@@ -531,21 +632,28 @@ class AugmentedModel(KerasRNN):
         self,
         _sentinel=None,
         train_augmentations=[], predict_augmentations=[],
+        prefetch_workers=0, prefetch_depth=8,
         **kwargs
     ):
         super().__init__(**kwargs)
 
         self.train_augmentations = train_augmentations
         self.predict_augmentations = predict_augmentations
+        self.prefetch_workers = prefetch_workers
+        self.prefetch_depth = prefetch_depth
+        self.tokenized_frames = TokenizedFrames()
 
     def _build_train_sequence(self, X, y, batch_size):
         return AugTrainSequence(
             data_transformer=self.data_transformer, target_transformer=self.target_transformer,
             X=X, y=y, batch_size=batch_size,
-            augmentations=self.train_augmentations)
+            augmentations=self.train_augmentations,
+            prefetch_workers=self.prefetch_workers, prefetch_depth=self.prefetch_depth,
+            tokenized_frames=self.tokenized_frames)
 
     def _build_test_sequence(self, X, batch_size):
         return AugTestSequence(
             data_transformer=self.data_transformer,
             X=X, batch_size=batch_size,
-            augmentations=self.predict_augmentations)
+            augmentations=self.predict_augmentations,
+            tokenized_frames=self.tokenized_frames)
@@ -45,6 +45,13 @@ def features(*features):
     return decorator
 
 
+def feature_columns(**columns):
+    def decorator(fn):
+        fn.feature_columns = columns
+        return fn
+    return decorator
+
+
 def submodels(*submodels):
     def decorator(fn):
         fn.submodels = submodels
@@ -941,6 +948,27 @@ def bigru_cnn_5_aug():
     )
 
 
+@features('clean2_no_punct', 'num1')
+def bigru_cnn_5_aug_ids():
+    return keras_models.AugmentedModel(
+        train_schedule=[dict(num_epochs=3, batch_size=128), dict(num_epochs=4, batch_size=256), dict(num_epochs=4, batch_size=512), dict(num_epochs=4, batch_size=1024), dict(num_epochs=10, batch_size=2048)],
+        predict_batch_size=1024, external_metrics=dict(roc_auc=roc_auc_score),
+        text_truncating='pre', text_padding='pre',
+        num_text_words=100000, max_text_len=100,
+        early_stopping_opts=dict(patience=5),
+        compile_opts=None,
+        model_fn=keras_models.bigru_cnn_1,
+        model_opts=dict(
+            lr=1e-3,
+            rnn_size=128, rnn_dropout=0.2, out_dropout=0.2,
+            text_emb_size=300, text_emb_file=input_file('crawl-300d-2M.vec'), text_emb_dropout=0.45, text_emb_rand_std=0.3
+        ),
+        train_augmentations=[augmentations.RandomCropIds(min_len=0.9, max_len=100)],
+        predict_augmentations=[augmentations.RandomCropIds(min_len=0.9, max_len=100)],
+        predict_passes=4,
+    )
+
+
 
 @features('clean2_corrected_fasttext', 'num1')
 def bigru_sterby_2_num_aug():
@@ -1135,6 +1163,25 @@ def bigru_cnn_4_aug6():
     )
 
 
+@features('multilang_clean4_corrected_fasttext', 'num1', 'num2', 'ind1', 'sentiment1')
+def bigru_cnn_4_aug6_ids():
+    return keras_models.AugmentedModel(
+        train_schedule=[dict(num_epochs=3, batch_size=128), dict(num_epochs=4, batch_size=256), dict(num_epochs=4, batch_size=512), dict(num_epochs=4, batch_size=1024), dict(num_epochs=10, batch_size=2048)],
+        predict_batch_size=1024, external_metrics=dict(roc_auc=roc_auc_score),
+        text_truncating='post', text_padding='post', ignore_columns=['comment_text__de', 'comment_text__fr', 'comment_text__es'],
+        num_text_words=100000, max_text_len=200,
+        early_stopping_opts=dict(patience=5),
+        compile_opts=None,
+        model_fn=keras_models.bigru_cnn_1,
+        model_opts=dict(
+            lr=1e-3,
+            rnn_size=128, rnn_dropout=0.3, out_dropout=0.2,
+            text_emb_size=300, text_emb_file=input_file('crawl-300d-2M.vec'), text_emb_dropout=0.45, text_emb_rand_std=0.3
+        ),
+        train_augmentations=[augmentations.RandomTranslation(0.35), augmentations.RandomConcatIds(0.05)],
+    )
+
+
 @features('multilang_clean4_corrected_fasttext', 'num1', 'num2', 'ind1', 'sentiment1')
 def bigru_cnn_5_aug6():
     return keras_models.AugmentedModel(
@@ -2137,7 +2184,7 @@ def l2_group_lgb23_b10():
             threat=800,
             insult=1000,
             identity_hate=1000
-        ), verbose_eval=50)))
+        ), verbose_eval=50), n_jobs=4))
 
 
 @submodels('l2_avg23', 'l2_group_lgb23_b10')
@@ -2289,6 +2336,7 @@ def l2_group_lgb24_tst1():
     'bigru_dpcnn_aug7_pre', 'dpcnn_bpe50k_aug7_pre', 'dpcnn_twitter_aug7_pre',
 )
 @features('num1', 'num2', 'ind1', 'sentiment1', 'api1')
+@feature_columns(api1=api_columns)
 def l2_group_lgb24_tst2():
     return Pipeline(
         make_union(
@@ -2387,6 +2435,7 @@ def l3_avg6_api():
     'bigru_dpcnn_aug7_pre', 'dpcnn_bpe50k_aug7_pre', 'dpcnn_twitter_aug7_pre',
 )
 @features('num1', 'num2', 'ind1', 'sentiment1', 'api1')
+@feature_columns(api1=api_columns)
 def l2_group_lgb24_api_b20():
     return Pipeline(
         make_union(
@@ -2419,7 +2468,7 @@ def l2_group_lgb24_api_b20():
             threat=800,
             insult=1000,
             identity_hate=1000
-        ), verbose_eval=50)))
+        ), verbose_eval=50), n_jobs=4))
 
 
 @submodels('l2_avg24', 'l2_group_lgb24_api_b20')
@@ -2596,6 +2645,7 @@ def l2_group_lgb25_api3():
     'bigru_dpcnn_aug7_pre', 'dpcnn_bpe50k_aug7_pre', 'dpcnn_twitter_aug7_pre', 'dpcnn_fasttext_aug7_pre'
 )
 @features('num1', 'num2', 'ind1', 'sentiment1', 'api3')
+@feature_columns(api3=sum([['%s_summary' % c] for c in api_columns], []))
 def l2_group_lgb25_api3_2():
     return Pipeline(
         Union(
@@ -2795,6 +2845,7 @@ def l2_group_et25_api3_3():
     'bigru_dpcnn_aug7_pre', 'dpcnn_bpe50k_aug7_pre', 'dpcnn_twitter_aug7_pre', 'dpcnn_fasttext_aug7_pre'
 )
 @features('num1', 'num2', 'ind1', 'sentiment1', 'api3_2')
+@feature_columns(api3_2=sum([['%s_summary' % c, '%s_min' % c, '%s_max' % c, '%s_mean' % c] for c in api_columns], []))
 def l2_group_lr25_api3_3():
     return Pipeline(
         Union(
@@ -0,0 +1,56 @@
+from aiohttp import web
+
+import time
+import random
+import hashlib
+import argparse
+
+
+def make_app(qps=None, fail_rate=0.0):
+    """ Local stand-in for comments:analyze endpoint, returning deterministic scores and injecting rate limit and server errors """
+    request_times = []
+
+    async def analyze(request):
+        now = time.monotonic()
+        request_times.append(now)
+        while request_times[0] < now - 1:
+            request_times.pop(0)
+
+        if qps is not None and len(request_times) > qps:
+            return web.json_response({'error': {'code': 429, 'message': 'Quota exceeded'}}, status=429)
+        if random.random() < fail_rate:
+            return web.json_response({'error': {'code': 503, 'message': 'Unavailable'}}, status=503)
+
+        body = await request.json()
+        text = body['comment']['text']
+        if len(text) > 3000:
+            return web.json_response({'error': {'code': 400, 'message': 'Comment text too long'}}, status=400)
+
+        scores = {}
+        for k in body['requestedAttributes']:
+            value = int(hashlib.md5((k + text).encode()).hexdigest()[:8], 16) / 2 ** 32
+            scores[k] = {
+                'spanScores': [{'begin': 0, 'end': len(text), 'score': {'value': value, 'type': 'PROBABILITY'}}],
+                'summaryScore': {'value': value, 'type': 'PROBABILITY'},
+            }
+
+        return web.json_response({'attributeScores': scores, 'languages': ['en']})
+
+    app = web.Application()
+    app.router.add_post('/v1alpha1/comments:analyze', analyze)
+    return app
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--port', type=int, default=8080)
+    parser.add_argument('--qps', type=float)
+    parser.add_argument('--fail-rate', type=float, default=0.0)
+
+    args = parser.parse_args()
+
+    print("Use API_URL=http://localhost:%d/v1alpha1/comments:analyze" % args.port)
+    web.run_app(make_app(args.qps, args.fail_rate), port=args.port)
+
+if __name__ == "__main__":
+    main()
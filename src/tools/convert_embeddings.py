@@ -0,0 +1,20 @@
+from src import meta
+from src.util.embeddings import EmbeddingIndex, load_emb_vectors, load_emb_valid
+
+import argparse
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('files', nargs='+')
+
+    args = parser.parse_args()
+
+    for filename in args.files:
+        print("Converting %s..." % filename)
+        EmbeddingIndex.load(filename, meta.cache_dir)
+        load_emb_vectors(filename, meta.cache_dir)
+        load_emb_valid(filename, meta.cache_dir)
+
+if __name__ == "__main__":
+    main()
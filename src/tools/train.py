@@ -36,6 +36,7 @@ def main():
     parser.add_argument('--skip-save', action='store_true')
     parser.add_argument('--force', action='store_true')
     parser.add_argument('--dump-features-to', type=str)
+    parser.add_argument('--feature-jobs', type=int)
 
     args = parser.parse_args()
 
@@ -43,7 +44,7 @@ def main():
     preset = getattr(presets, preset_name)
     preset_dir = os.path.join(meta.cache_dir, preset_name)
 
-    train_X, train_y, test_X = meta.get_input_data(preset)
+    train_X, train_y, test_X = meta.get_input_data(preset, n_jobs=args.feature_jobs)
 
     if hasattr(preset, 'submodels'):
         train_X = [train_X]
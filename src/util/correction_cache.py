@@ -0,0 +1,59 @@
+import os
+import sqlite3
+
+from contextlib import contextmanager
+
+
+class CorrectionCache:
+    """
+    Persistent word corrections shared by processes.
+
+    Entries are stored in sqlite database, so parallel workers may read and add corrections
+    concurrently. Every correction is stored with hash of vocabulary it was made with and json strings
+    of what it depends on (see Corrector), vocabularies are stored too, so corrections may be checked
+    against another one. Corrections are lists of words without spaces and are stored space-joined.
+    """
+
+    def __init__(self, filename):
+        self.filename = filename
+
+    def load(self):
+        """ List of (word, vocabulary hash, corrections, deps, probes) """
+        if not os.path.exists(self.filename):
+            return []
+
+        with self._connect() as conn:
+            return [(word, voc, corrs.split(), deps, probes) for word, voc, corrs, deps, probes in conn.execute('SELECT word, voc, corrs, deps, probes FROM corrections')]
+
+    def save(self, voc, entries):
+        """ Save (word, corrections, deps, probes) entries made with vocabulary of given hash """
+        if len(entries) == 0:
+            return
+
+        os.makedirs(os.path.dirname(self.filename), exist_ok=True)
+        with self._connect() as conn:
+            conn.executemany('INSERT OR IGNORE INTO corrections VALUES (?, ?, ?, ?, ?)', ((word, voc, ' '.join(corrs), deps, probes) for word, corrs, deps, probes in entries))
+
+    def load_vocabulary(self, voc):
+        if not os.path.exists(self.filename):
+            return None
+
+        with self._connect() as conn:
+            row = conn.execute('SELECT words FROM vocabularies WHERE voc = ?', (voc,)).fetchone()
+        return None if row is None else set(row[0].split(' '))
+
+    def save_vocabulary(self, voc, words):
+        os.makedirs(os.path.dirname(self.filename), exist_ok=True)
+        with self._connect() as conn:
+            conn.execute('INSERT OR IGNORE INTO vocabularies VALUES (?, ?)', (voc, ' '.join(words)))
+
+    @contextmanager
+    def _connect(self):
+        conn = sqlite3.connect(self.filename, timeout=600)
+        try:
+            with conn:  # Commit on success
+                conn.execute('CREATE TABLE IF NOT EXISTS corrections (word TEXT NOT NULL, voc TEXT NOT NULL, corrs TEXT NOT NULL, deps TEXT NOT NULL, probes TEXT NOT NULL, PRIMARY KEY (word, voc))')
+                conn.execute('CREATE TABLE IF NOT EXISTS vocabularies (voc TEXT PRIMARY KEY, words TEXT NOT NULL)')
+                yield conn
+        finally:
+            conn.close()
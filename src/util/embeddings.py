@@ -0,0 +1,150 @@
+import os
+
+import numpy as np
+
+
+default_cache_dir = os.getenv('CACHE_DIR', 'cache')
+
+
+def get_sidecar_prefix(filename, cache_dir=None):
+    stat = os.stat(filename)
+    return os.path.join(cache_dir or default_cache_dir, 'embeddings', '%s-%d-%d' % (os.path.basename(filename), stat.st_size, stat.st_mtime_ns))
+
+
+class EmbeddingIndex:
+    """
+    Tokens of embedding text file (word2vec / glove format) together with byte offsets of their rows.
+
+    Index is built by a single pass over the file and stored in sidecar files in the cache directory,
+    keyed by embedding file name, size and modification time, so later loads don't parse the vectors.
+    """
+
+    def __init__(self, tokens, offsets):
+        self.tokens = tokens
+        self.offsets = offsets
+
+    @classmethod
+    def load(cls, filename, cache_dir=None):
+        prefix = get_sidecar_prefix(filename, cache_dir)
+
+        if not os.path.exists(prefix + '.offsets.npy'):
+            cls.build(filename).save(prefix)
+
+        offsets = np.load(prefix + '.offsets.npy', mmap_mode='r')
+        with open(prefix + '.tokens', encoding='utf-8') as f:
+            tokens = f.read().split('\n') if len(offsets) > 0 else []
+
+        return cls(tokens, offsets)
+
+    @classmethod
+    def build(cls, filename):
+        tokens, offsets = [], []
+        ofs = 0
+
+        with open(filename, 'rb') as f:
+            for line in f:
+                tokens.append(line.decode('utf-8').split(maxsplit=1)[0])
+                offsets.append(ofs)
+                ofs += len(line)
+
+        return cls(tokens, np.array(offsets, dtype=np.int64))
+
+    def save(self, prefix):
+        os.makedirs(os.path.dirname(prefix), exist_ok=True)
+
+        # Offsets are written last and mark the index as complete, tmp files are renamed atomically for concurrent builders
+        with open(prefix + '.tokens.tmp%d' % os.getpid(), 'w', encoding='utf-8') as f:
+            f.write('\n'.join(self.tokens))
+        os.replace(prefix + '.tokens.tmp%d' % os.getpid(), prefix + '.tokens')
+
+        with open(prefix + '.offsets.tmp%d' % os.getpid(), 'wb') as f:
+            np.save(f, self.offsets)
+        os.replace(prefix + '.offsets.tmp%d' % os.getpid(), prefix + '.offsets.npy')
+
+    def vocabulary(self):
+        return set(self.tokens)
+
+    def rows(self, valid=None):
+        """ Token -> row mapping, later rows win for duplicate tokens; if valid mask is given, other rows are skipped """
+        rows = range(len(self.tokens)) if valid is None else np.flatnonzero(valid).tolist()
+        return {self.tokens[i]: i for i in rows}
+
+
+def load_emb_vectors(filename, cache_dir=None):
+    """
+    Memory-mapped float32 matrix of embedding file vectors, row-aligned with EmbeddingIndex tokens.
+    Rows which are not vectors (like word2vec header) are filled with nan.
+    """
+    prefix = get_sidecar_prefix(filename, cache_dir)
+
+    if not os.path.exists(prefix + '.vectors.npy'):
+        convert_emb_vectors(filename, prefix + '.vectors.npy', cache_dir)
+
+    return np.load(prefix + '.vectors.npy', mmap_mode='r')
+
+
+def load_emb_valid(filename, cache_dir=None):
+    """ Mask of embedding file rows which are vectors """
+    prefix = get_sidecar_prefix(filename, cache_dir)
+
+    if not os.path.exists(prefix + '.valid.npy'):
+        vectors = load_emb_vectors(filename, cache_dir)
+        valid = np.ones(len(vectors), dtype=np.bool_)
+        for ofs in range(0, len(vectors), 100000):
+            valid[ofs:ofs+100000] = ~np.isnan(vectors[ofs:ofs+100000, 0])
+
+        tmp = prefix + '.valid.tmp%d.npy' % os.getpid()
+        np.save(tmp, valid)
+        os.replace(tmp, prefix + '.valid.npy')
+
+    return np.load(prefix + '.valid.npy')
+
+
+def convert_emb_vectors(filename, target, cache_dir=None):
+    index = EmbeddingIndex.load(filename, cache_dir)
+
+    with open(filename, 'rb') as f:
+        header = f.readline().split()
+        first = header if len(header) > 2 else f.readline().split()
+    dim = len(first) - 1 if len(header) > 2 else int(header[1])
+
+    os.makedirs(os.path.dirname(target), exist_ok=True)
+    tmp = target + '.tmp%d.npy' % os.getpid()
+
+    vectors = np.lib.format.open_memmap(tmp, mode='w+', dtype=np.float32, shape=(len(index.tokens), dim))
+    with open(filename, 'rb') as f:
+        for i, line in enumerate(f):
+            values = line.split()[1:]
+            vectors[i] = np.array(values, dtype=np.float32) if len(values) == dim else np.nan
+    vectors.flush()
+    del vectors
+
+    os.replace(tmp, target)
+
+
+def load_emb_matrix(filename, word_index, voc_size, emb_size, rand_std=None, cache_dir=None):
+    """
+    Build [voc_size, emb_size] embedding weights for tokenizer word_index, reading only rows of known words.
+    Words missing in embedding file get zero vectors, or random normal ones if rand_std is set.
+
+    Keeps semantics of the line-by-line kgutil loader: random weights are drawn for the whole matrix before
+    reading (same np.random stream use), lines which aren't emb_size vectors are skipped and of the other ones
+    later rows win for duplicate tokens. Result is float32, which Keras casts embedding weights to anyway.
+    """
+    vectors = load_emb_vectors(filename, cache_dir)
+    if vectors.shape[1] != emb_size:
+        raise ValueError("Embedding file %s has vectors of size %d, not %d" % (filename, vectors.shape[1], emb_size))
+
+    if rand_std is None:
+        res = np.zeros((voc_size, emb_size), dtype=np.float32)
+    else:
+        res = np.random.normal(0, rand_std, (voc_size, emb_size)).astype(np.float32)
+
+    rows = EmbeddingIndex.load(filename, cache_dir).rows(load_emb_valid(filename, cache_dir))
+    words = [(i, rows[w]) for w, i in word_index.items() if i < voc_size and w in rows]
+    if len(words) == 0:
+        return res
+
+    word_ids, word_rows = map(np.array, zip(*words))
+    res[word_ids] = vectors[word_rows]
+    return res
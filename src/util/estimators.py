@@ -2,9 +2,11 @@ import numpy as np
 import pandas as pd
 
 import re
+import inspect
 
 from sklearn.multioutput import MultiOutputClassifier
-from sklearn.utils import resample
+from sklearn.utils import resample, check_random_state
+from joblib import Parallel, delayed, cpu_count
 
 from copy import deepcopy
 
@@ -64,21 +66,23 @@ class OnExtendedData:
     def _extend_train_data(self, train_X, train_y):
         assert all(d == np.object for d in train_X.dtypes.values)
 
-        cand_X = train_X
-        cand_y = train_y
+        cand_idx = np.arange(len(train_X))
 
         if self.max_len is not None:
-            selected = (cand_X.applymap(lambda t: len(re.split('\W+', t))).max(axis=1) < self.max_len).values
-            cand_X = cand_X.loc[selected]
-            cand_y = cand_y.loc[selected]
+            lengths = np.array([[len(re.split('\W+', t)) for t in train_X[c].values] for c in train_X.columns])
+            cand_idx = cand_idx[lengths.max(axis=0) < self.max_len]
 
-        print("Selected %d candidates" % cand_X.shape[0])
+        print("Selected %d candidates" % len(cand_idx))
 
-        left_X, left_y = resample(cand_X, cand_y, n_samples=self.n_samples)
-        right_X, right_y = resample(cand_X, cand_y, n_samples=self.n_samples)
+        # Only positions of pair parts are sampled, texts are joined for generated rows alone
+        left_idx = resample(cand_idx, n_samples=self.n_samples)
+        right_idx = resample(cand_idx, n_samples=self.n_samples)
 
-        generated_X = left_X.reset_index(drop=True) + ' ' + right_X.reset_index(drop=True)
-        generated_y = ((left_y.reset_index(drop=True) + right_y.reset_index(drop=True)) * self.decay).clip(upper=1)
+        texts = train_X.values
+        generated_X = pd.DataFrame(texts[left_idx] + ' ' + texts[right_idx], columns=train_X.columns)
+
+        labels = train_y.values
+        generated_y = pd.DataFrame(np.minimum((labels[left_idx] + labels[right_idx]) * self.decay, 1), columns=train_y.columns)
 
         return pd.concat((train_X, generated_X)), pd.concat((train_y, generated_y))
 
@@ -114,21 +118,83 @@ class Pipeline:
         return X
 
 
+def limit_threads(model, n_threads):
+    """ Cap number of threads used by model with `nthread` parameter (LightGBM and XGBoost wrappers) """
+    params = getattr(model, 'params', None)
+    if isinstance(params, dict):
+        params['nthread'] = min(params.get('nthread', n_threads), n_threads)
+
+
+def accepts_arg(fn, name):
+    return name in inspect.getargspec(fn).args
+
+
+def fit_bag(model, seed, train_X, train_y, eval_X, eval_y, sample_size, sample_replace, n_threads):
+    """
+    Fit model on bag of train rows. Models accepting `train_idx` get positions of bag rows and take them
+    from the shared frame, sklearn-like models without fit_eval get bag row counts as sample weights,
+    others get a resampled copy of the frame.
+    """
+    bag_idx = resample(np.arange(len(train_X)), n_samples=int(sample_size * len(train_X)), replace=sample_replace, random_state=seed)
+    if n_threads is not None:
+        limit_threads(model, n_threads)
+
+    if not hasattr(model, 'fit_eval'):
+        model.fit(train_X, train_y, sample_weight=np.bincount(bag_idx, minlength=len(train_X)))
+    elif accepts_arg(model.fit_eval, 'train_idx'):
+        model.fit_eval(train_X, train_y, eval_X, eval_y, train_idx=bag_idx)
+    else:
+        model.fit_eval(train_X.iloc[bag_idx], train_y.iloc[bag_idx], eval_X, eval_y)
+    return model
+
+
+def predict_bags(models, X):
+    res = np.array(models[0].predict(X), dtype=np.float64)
+    for m in models[1:]:
+        res += m.predict(X)
+    return res
+
+
 class Bagged:
+    """
+    Average of models fitted on resampled train data.
 
-    def __init__(self, n, model, sample_size=1.0, sample_replace=True):
+    Bags are resampled with seeds drawn from `random_state` (or the global numpy random state), so fitted bags
+    don't depend on `n_jobs`. With `n_jobs` > 1 bags are fitted and predicted in that many processes,
+    and each model is limited to cpu_count / n_jobs threads.
+    """
+
+    def __init__(self, n, model, sample_size=1.0, sample_replace=True, n_jobs=1, random_state=None):
         self.n = n
         self.sample_size = sample_size
         self.sample_replace = sample_replace
         self.model = model
+        self.n_jobs = n_jobs
+        self.random_state = random_state
 
     def fit_eval(self, train_X, train_y, eval_X, eval_y):
-        self.fitted_models = []
-        for i in range(self.n):
-            bag_train_X, bag_train_y = resample(train_X, train_y, n_samples=int(self.sample_size * len(train_X)), replace=self.sample_replace)
-            model = deepcopy(self.model)
-            model.fit_eval(bag_train_X, bag_train_y, eval_X, eval_y)
-            self.fitted_models.append(model)
+        seeds = check_random_state(self.random_state).randint(2 ** 31, size=self.n)
+
+        if self.n_jobs <= 1:
+            self.fitted_models = [
+                fit_bag(deepcopy(self.model), seed, train_X, train_y, eval_X, eval_y, self.sample_size, self.sample_replace, None)
+                for seed in seeds
+            ]
+        else:
+            n_threads = max(1, cpu_count() // self.n_jobs)
+            self.fitted_models = Parallel(self.n_jobs)(
+                delayed(fit_bag)(deepcopy(self.model), seed, train_X, train_y, eval_X, eval_y, self.sample_size, self.sample_replace, n_threads)
+                for seed in seeds
+            )
 
     def predict(self, X):
-        return sum(m.predict(X) for m in self.fitted_models) / len(self.fitted_models)
+        n_jobs = min(getattr(self, 'n_jobs', 1), len(self.fitted_models))
+        if n_jobs <= 1:
+            return predict_bags(self.fitted_models, X) / len(self.fitted_models)
+
+        chunks = Parallel(n_jobs)(delayed(predict_bags)(self.fitted_models[i::n_jobs], X) for i in range(n_jobs))
+
+        res = np.zeros(chunks[0].shape)
+        for chunk in chunks:
+            res += chunk
+        return res / len(self.fitted_models)
@@ -0,0 +1,231 @@
+import os
+import json
+import mmap
+import uuid
+import shutil
+
+import numpy as np
+import pandas as pd
+
+
+class FeatureStore:
+    """
+    Columnar on-disk storage for feature frames.
+
+    Every feature is a directory (symlink to its current version) with a `meta.json` descriptor and one set of files per column,
+    so a reader can load only the columns it needs. Numeric columns are stored as `.npy` files
+    and opened memory-mapped, text columns as utf-8 bytes plus int64 offsets, columns of 1-d arrays
+    (like token ids) as flat memory-mapped values plus offsets, anything else falls back to a per-column pickle.
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+
+    def exists(self, name):
+        return os.path.exists(self._meta_file(name))
+
+    def read_meta(self, name):
+        return self._load_version(name, self._read_meta_dir)
+
+    def columns(self, name):
+        return [c['name'] for c in self.read_meta(name)['columns']]
+
+    def save(self, name, df, row_hashes=None, **extra_meta):
+        """ Save feature frame, optionally with hashes of input rows it was computed from (aligned with frame rows) """
+        feature_dir = os.path.join(self.directory, name)
+
+        # Every version is written to its own directory and published by atomic replace of the feature symlink,
+        # so concurrent writers don't touch each other's files and readers never see a missing or partial feature
+        version = '%s-%d-%s' % (name, os.getpid(), uuid.uuid4().hex)
+        data_dir = os.path.join(self.directory, '.versions', version)
+        os.makedirs(data_dir)
+
+        meta = dict(extra_meta)
+        meta['length'] = len(df)
+        meta['index'] = self._write_column(data_dir, 'index', pd.Series(df.index.values, name=df.index.name))
+        meta['index']['name'] = df.index.name
+        meta['columns'] = []
+
+        for i, col in enumerate(df.columns):
+            col_meta = self._write_column(data_dir, 'col-%d' % i, df[col])
+            col_meta['name'] = col
+            meta['columns'].append(col_meta)
+
+        if row_hashes is not None:
+            np.save(os.path.join(data_dir, 'row_hashes.npy'), np.asarray(row_hashes, dtype=np.uint64))
+            meta['has_row_hashes'] = True
+
+        with open(os.path.join(data_dir, 'meta.json'), 'w') as f:
+            json.dump(meta, f)
+
+        link = feature_dir + '.link%d' % os.getpid()
+        if os.path.lexists(link):
+            os.remove(link)
+        os.symlink(os.path.join('.versions', version), link)
+
+        old_dir = None
+        if os.path.islink(feature_dir):
+            old_dir = os.path.realpath(feature_dir)
+        elif os.path.isdir(feature_dir):  # Feature saved before versioning
+            old_dir = feature_dir + '.old%d' % os.getpid()
+            os.rename(feature_dir, old_dir)
+
+        os.replace(link, feature_dir)
+
+        if old_dir is not None:
+            shutil.rmtree(old_dir, ignore_errors=True)
+
+    def update(self, name, df, row_hashes=None, **extra_meta):
+        """ Replace rows of stored feature with rows of df having the same ids and append the other ones """
+        existing, existing_hashes = self._load_version(name, lambda version_dir: (self._load_dir(name, version_dir), self._load_row_hashes_dir(version_dir)))
+        if list(existing.columns) != list(df.columns):
+            raise ValueError("Can't update feature %r with columns %r by columns %r" % (name, list(existing.columns), list(df.columns)))
+
+        kept = ~existing.index.isin(df.index)
+        if row_hashes is not None and existing_hashes is not None:
+            row_hashes = np.concatenate((existing_hashes[kept], row_hashes))
+        else:
+            row_hashes = None
+
+        self.save(name, pd.concat((existing[kept], df)), row_hashes=row_hashes, **extra_meta)
+
+    def load_row_hashes(self, name):
+        return self._load_version(name, self._load_row_hashes_dir)
+
+    def load_index(self, name):
+        return self._load_version(name, self._load_index_dir)
+
+    def load(self, name, columns=None):
+        return self._load_version(name, lambda version_dir: self._load_dir(name, version_dir, columns))
+
+    def _load_version(self, name, fn, attempts=5):
+        """
+        Call fn with directory of the current feature version. The symlink is resolved once, so all files come from one version;
+        if a concurrent save removes that version in the meantime, the new one is read instead.
+        """
+        for attempt in range(attempts):
+            version_dir = os.path.realpath(os.path.join(self.directory, name))
+            try:
+                return fn(version_dir)
+            except FileNotFoundError:
+                if attempt == attempts - 1 or os.path.realpath(os.path.join(self.directory, name)) == version_dir:
+                    raise
+
+    def _read_meta_dir(self, version_dir):
+        with open(os.path.join(version_dir, 'meta.json')) as f:
+            return json.load(f)
+
+    def _load_row_hashes_dir(self, version_dir):
+        if not self._read_meta_dir(version_dir).get('has_row_hashes'):
+            return None
+        return np.load(os.path.join(version_dir, 'row_hashes.npy'))
+
+    def _load_index_dir(self, version_dir, meta=None):
+        meta = meta or self._read_meta_dir(version_dir)
+        return pd.Index(self._read_column(version_dir, meta['index']), name=meta['index']['name'])
+
+    def _load_dir(self, name, version_dir, columns=None):
+        meta = self._read_meta_dir(version_dir)
+
+        col_metas = meta['columns']
+        if columns is not None:
+            by_name = {c['name']: c for c in col_metas}
+            missing = [c for c in columns if c not in by_name]
+            if len(missing) > 0:
+                raise KeyError("Feature %r has no columns %r" % (name, missing))
+            col_metas = [by_name[c] for c in columns]
+
+        res = pd.DataFrame(index=self._load_index_dir(version_dir, meta))
+        for col_meta in col_metas:
+            res[col_meta['name']] = self._read_column(version_dir, col_meta)
+        return res
+
+    def _meta_file(self, name):
+        return os.path.join(self.directory, name, 'meta.json')
+
+    def _write_column(self, directory, key, series):
+        path = os.path.join(directory, key)
+        values = series.values
+
+        if values.dtype != np.object_:
+            np.save(path + '.npy', values)
+            return dict(file=key, kind='numeric', dtype=str(values.dtype))
+
+        if all(isinstance(v, str) or (isinstance(v, float) and np.isnan(v)) for v in values):
+            nulls = np.array([not isinstance(v, str) for v in values], dtype=np.bool_)
+            encoded = [v.encode('utf-8') if isinstance(v, str) else b'' for v in values]
+
+            offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+            np.cumsum([len(e) for e in encoded], out=offsets[1:])
+
+            with open(path + '.bytes', 'wb') as f:
+                for e in encoded:
+                    f.write(e)
+            np.save(path + '.offsets.npy', offsets)
+            if nulls.any():
+                np.save(path + '.nulls.npy', nulls)
+
+            return dict(file=key, kind='text', has_nulls=bool(nulls.any()))
+
+        if self._is_ragged(values):
+            nulls = np.array([not isinstance(v, np.ndarray) for v in values], dtype=np.bool_)
+            arrays = [v for v in values if isinstance(v, np.ndarray)]
+
+            offsets = np.zeros(len(values) + 1, dtype=np.int64)
+            np.cumsum([len(v) if isinstance(v, np.ndarray) else 0 for v in values], out=offsets[1:])
+
+            np.save(path + '.flat.npy', np.concatenate(arrays))
+            np.save(path + '.offsets.npy', offsets)
+            if nulls.any():
+                np.save(path + '.nulls.npy', nulls)
+
+            return dict(file=key, kind='ragged', has_nulls=bool(nulls.any()))
+
+        pd.to_pickle(values, path + '.pickle')
+        return dict(file=key, kind='object')
+
+    def _is_ragged(self, values):
+        """ Check if values are 1-d numeric arrays of the same dtype or nans """
+        arrays = [v for v in values if isinstance(v, np.ndarray)]
+        if len(arrays) == 0 or arrays[0].dtype == np.object_:
+            return False
+        if any(a.ndim != 1 or a.dtype != arrays[0].dtype for a in arrays):
+            return False
+        return all(isinstance(v, np.ndarray) or (isinstance(v, float) and np.isnan(v)) for v in values)
+
+    def _read_column(self, directory, col_meta):
+        path = os.path.join(directory, col_meta['file'])
+
+        if col_meta['kind'] == 'numeric':
+            return np.load(path + '.npy', mmap_mode='r')
+
+        if col_meta['kind'] == 'text':
+            offsets = np.load(path + '.offsets.npy', mmap_mode='r')
+            res = np.empty(len(offsets) - 1, dtype=np.object_)
+
+            if offsets[-1] > 0:
+                with open(path + '.bytes', 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as buf:
+                    for i, (start, end) in enumerate(zip(offsets[:-1].tolist(), offsets[1:].tolist())):
+                        res[i] = buf[start:end].decode('utf-8')
+            else:
+                res[:] = ''
+
+            if col_meta.get('has_nulls'):
+                res[np.load(path + '.nulls.npy')] = np.nan
+
+            return res
+
+        if col_meta['kind'] == 'ragged':
+            offsets = np.load(path + '.offsets.npy')
+            flat = np.load(path + '.flat.npy', mmap_mode='r')
+
+            res = np.empty(len(offsets) - 1, dtype=np.object_)
+            for i, (start, end) in enumerate(zip(offsets[:-1].tolist(), offsets[1:].tolist())):
+                res[i] = flat[start:end]
+
+            if col_meta.get('has_nulls'):
+                res[np.load(path + '.nulls.npy')] = np.nan
+
+            return res
+
+        return pd.read_pickle(path + '.pickle')
@@ -0,0 +1,255 @@
+import os
+import re
+import json
+import time
+import random
+import asyncio
+
+import aiohttp
+import numpy as np
+import pandas as pd
+
+
+api_url = os.getenv('API_URL', 'https://commentanalyzer.googleapis.com/v1alpha1/comments:analyze')
+
+attributes = ['UNSUBSTANTIAL', 'LIKELY_TO_REJECT', 'OBSCENE', 'SEVERE_TOXICITY', 'TOXICITY', 'INFLAMMATORY', 'SPAM', 'ATTACK_ON_AUTHOR', 'INCOHERENT', 'ATTACK_ON_COMMENTER']
+
+eos_pattern = re.compile(r"[!?.]\s+")
+eow_pattern = re.compile(r"\s+")
+
+
+class ApiError(Exception):
+    pass
+
+
+class TokenBucket:
+    """ Rate limiter allowing `rate` acquisitions per second on average with bursts up to `capacity` """
+
+    def __init__(self, rate, capacity=None):
+        self.rate = rate
+        self.capacity = capacity or rate
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.lock = asyncio.Lock()
+
+    async def acquire(self):
+        async with self.lock:  # Waiters are served in order
+            while True:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+
+
+def split_text(text, min_len, max_len):
+    parts = []
+
+    pos = 0
+    while len(text) - pos > max_len:
+        split_match = eos_pattern.search(text, pos + min_len, pos + max_len)
+        if split_match is None:
+            split_match = eow_pattern.search(text, pos + min_len, pos + max_len)
+        if split_match is None:
+            split_pos = pos + min_len
+        else:
+            split_pos = split_match.end()
+        parts.append(text[pos:split_pos])
+        pos = split_pos
+
+    parts.append(text[pos:])
+    return parts
+
+
+def aggregate_responses(responses):
+    res = {}
+
+    for k in attributes:
+        vals = [r[k] for r in responses]
+        res[k] = {
+            'spanScores': sum([v['spanScores'] for v in vals], []),
+            'summaryScore': {'type': 'PROBABILITY', 'value': (sum(v['summaryScore']['value'] for v in vals) / len(vals))},
+            'parts': vals
+        }
+
+    return res
+
+
+class AnalyzeClient:
+    """
+    Client of comments:analyze endpoint sharing keep-alive connections of aiohttp session.
+    Rate limited and transient errors (connection errors, timeouts, 429 and 5xx responses) are retried with exponential backoff.
+    """
+
+    def __init__(self, session, limiter, api_key, url=api_url, max_retries=6, backoff=1.0):
+        self.session = session
+        self.limiter = limiter
+        self.api_key = api_key
+        self.url = url
+        self.max_retries = max_retries
+        self.backoff = backoff
+
+    async def analyze(self, text):
+        if len(text) > 2900:
+            return aggregate_responses(await asyncio.gather(*[self.analyze(p) for p in split_text(text, 2000, 2900)]))
+
+        return await self.request(text)
+
+    async def request(self, text):
+        body = {
+            'comment': {'text': text},
+            'requestedAttributes': {k: {} for k in attributes},
+        }
+
+        for attempt in range(self.max_retries + 1):
+            if attempt > 0:
+                await asyncio.sleep(self.backoff * 2 ** (attempt - 1) * (0.5 + random.random()))
+
+            await self.limiter.acquire()
+            try:
+                async with self.session.post(self.url, params={'key': self.api_key or ''}, json=body) as resp:
+                    if resp.status == 200:
+                        return (await resp.json())['attributeScores']
+
+                    error = 'HTTP %d: %s' % (resp.status, (await resp.text())[:200])
+                    if resp.status != 429 and resp.status < 500:
+                        raise ApiError(error)
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                error = repr(e)
+
+        raise ApiError(error)
+
+
+def read_response_log(log_file):
+    """ Successful responses from append-only log, keyed by row id """
+    res = {}
+    if not os.path.exists(log_file):
+        return res
+
+    with open(log_file) as f:
+        for line in f:
+            try:
+                entry = json.loads(line)
+            except ValueError:  # Line truncated by interrupted run
+                continue
+
+            if 'response' in entry:
+                res[entry['id']] = entry['response']
+
+    return res
+
+
+async def analyze_all(items, log_file, api_key, url, rate, concurrency, timeout, max_retries, backoff):
+    limiter = TokenBucket(rate)
+    connector = aiohttp.TCPConnector(limit=concurrency)
+
+    async with aiohttp.ClientSession(connector=connector, timeout=aiohttp.ClientTimeout(total=timeout)) as session:
+        client = AnalyzeClient(session, limiter, api_key, url, max_retries, backoff)
+
+        with open(log_file, 'a') as log:
+            async def worker(items):
+                for key, text in items:
+                    try:
+                        entry = dict(id=key, response=await client.analyze(text))
+                    except ApiError as e:
+                        print("Request for %s failed: %s" % (key, e))
+                        entry = dict(id=key, error=str(e))
+
+                    log.write(json.dumps(entry) + '\n')
+                    log.flush()
+
+            items = iter(items)  # Shared by all workers, so each item is taken once
+            await asyncio.gather(*[worker(items) for _ in range(concurrency)])
+
+
+def analyze_comments(texts, log_file, api_key=None, url=api_url, rate=10, concurrency=20, timeout=60, max_retries=6, backoff=1.0):
+    """
+    Analyze texts series with at most `rate` requests per second, returning series of attribute scores (None for failed rows).
+    Responses are appended to `log_file` as they arrive, so interrupted run resumes from the rows still missing there.
+    Rows which failed are retried on the next run.
+    """
+    done = read_response_log(log_file)
+    todo = [(str(k), text) for k, text in texts.items() if str(k) not in done]
+
+    if len(todo) > 0:
+        print("Analyzing %d of %d texts..." % (len(todo), len(texts)))
+
+        os.makedirs(os.path.dirname(log_file) or '.', exist_ok=True)
+        loop = asyncio.new_event_loop()
+        try:
+            loop.run_until_complete(analyze_all(todo, log_file, api_key, url, rate, concurrency, timeout, max_retries, backoff))
+        finally:
+            loop.close()
+
+        done = read_response_log(log_file)
+
+    return pd.Series([done.get(str(k)) for k in texts.index], index=texts.index)
+
+
+class ApiScores:
+    """
+    Attribute scores of API responses flattened to arrays: summary scores as [rows, attributes] matrix
+    and span scores as flat float32 values with offsets per (row, attribute) pair in row-major order.
+    Attributes are ordered by first appearance, missing responses (None or error strings) have no scores.
+    """
+
+    def __init__(self, responses):
+        self.attributes = []
+        attribute_ids = {}
+        for resp in responses:
+            if isinstance(resp, dict):
+                for k in resp:
+                    if k not in attribute_ids:
+                        attribute_ids[k] = len(self.attributes)
+                        self.attributes.append(k)
+
+        self.summary = np.full((len(responses), len(self.attributes)), np.nan)
+        self.counts = np.zeros((len(responses), len(self.attributes)), dtype=np.int64)
+
+        values = []
+        for i, resp in enumerate(responses):
+            if not isinstance(resp, dict):
+                continue
+
+            row_spans = [()] * len(self.attributes)
+            for k, v in resp.items():
+                j = attribute_ids[k]
+                self.summary[i, j] = v['summaryScore']['value']
+                row_spans[j] = [span['score']['value'] for span in v['spanScores']]
+                self.counts[i, j] = len(row_spans[j])
+
+            for spans in row_spans:
+                values.extend(spans)
+
+        self.values = np.array(values, dtype=np.float32)
+        self.offsets = np.zeros(self.counts.size + 1, dtype=np.int64)
+        np.cumsum(self.counts.ravel(), out=self.offsets[1:])
+
+    def reduce(self, ufunc, values=None):
+        """ Segment reduction of span values for every (row, attribute) pair, nan for pairs without spans """
+        values = self.values if values is None else values
+        counts = self.counts.ravel()
+
+        res = np.full(len(counts), np.nan)
+        if len(values) > 0:
+            res[counts > 0] = ufunc.reduceat(values, self.offsets[:-1][counts > 0])
+        return res.reshape(self.counts.shape)
+
+    def stats(self):
+        values = self.values.astype(np.float64)
+        counts = self.counts.ravel()
+
+        mean = self.reduce(np.add, values) / self.counts
+        deviations = values - np.repeat(mean.ravel()[counts > 0], counts[counts > 0])
+
+        return dict(
+            summary=self.summary,
+            min=self.reduce(np.minimum),
+            max=self.reduce(np.maximum),
+            mean=mean,
+            std=np.sqrt(self.reduce(np.add, deviations ** 2) / self.counts),
+        )
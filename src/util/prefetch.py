@@ -0,0 +1,176 @@
+import queue
+import traceback
+import multiprocessing as mp
+
+import numpy as np
+
+
+def flatten_batch(batch, leaves):
+    """ Replace arrays of nested dicts / tuples / lists with their positions in leaves list """
+    if isinstance(batch, dict):
+        return {k: flatten_batch(v, leaves) for k, v in batch.items()}
+    if isinstance(batch, (tuple, list)):
+        return type(batch)(flatten_batch(v, leaves) for v in batch)
+
+    leaves.append(np.asarray(batch))
+    return len(leaves) - 1
+
+
+def unflatten_batch(spec, leaves):
+    if isinstance(spec, dict):
+        return {k: unflatten_batch(v, leaves) for k, v in spec.items()}
+    if isinstance(spec, (tuple, list)):
+        return type(spec)(unflatten_batch(v, leaves) for v in spec)
+
+    return leaves[spec]
+
+
+def prefetch_work(fn, items, buffer, taken, consumed, cond, results, depth, slot_size):
+    """ Worker loop of BatchPrefetcher: compute fn(i) for given (position, i) items and pass them to the parent """
+    buf = np.frombuffer(buffer, dtype=np.uint8)
+
+    for pos, i in items:
+        with cond:
+            cond.wait_for(lambda: consumed.value > pos - depth)
+            if taken[pos]:  # Computed by the parent, its slot may belong to a pending position now
+                continue
+
+        try:
+            batch = fn(i)
+        except Exception:
+            results.put((pos, 'error', None, traceback.format_exc()))
+            return
+
+        leaves = []
+        spec = flatten_batch(batch, leaves)
+
+        if any(a.dtype == np.object_ for a in leaves) or sum(a.nbytes for a in leaves) > slot_size:
+            results.put((pos, None, None, batch))
+            continue
+
+        layout = []
+        ofs = (pos % depth) * slot_size
+        for a in leaves:
+            buf[ofs:ofs+a.nbytes] = np.ascontiguousarray(a).reshape(-1).view(np.uint8)
+            layout.append((a.dtype.str, a.shape, ofs))
+            ofs += a.nbytes
+
+        results.put((pos, spec, layout, None))
+
+
+class BatchPrefetcher:
+    """
+    Computes batches fn(indices[p]) for positions p of given list of indices in worker processes ahead of consumption.
+
+    Batches (numpy arrays nested in dicts, tuples and lists) are written to a ring of `depth` shared memory slots,
+    batch at position p goes to slot p % depth once all positions before p - depth are taken, so at most `depth`
+    batches are kept ahead of the first position not taken. Slots are sized by the first batch, which is computed
+    in the calling process; batches which don't fit (or hold non-numeric arrays) are passed pickled through
+    the result queue instead.
+
+    `get(p)` returns batch at position p, the first one not taken by default. Positions may be requested in any order,
+    ones workers won't produce (taken already, or `depth` and more ahead of the first one not taken) are computed
+    in the calling process. While waiting for batches workers are checked to be alive.
+
+    Workers are started from a forkserver rather than forked from a process which may run TensorFlow or other
+    threads, so fn must be picklable.
+    """
+
+    poll_interval = 1.0
+
+    def __init__(self, fn, indices, n_workers, depth):
+        self.fn = fn
+        self.indices = list(indices)
+        self.depth = depth
+
+        self.first = fn(self.indices[0])
+        leaves = []
+        flatten_batch(self.first, leaves)
+        self.slot_size = (int(sum(a.nbytes for a in leaves) * 1.25) // 64 + 1) * 64
+
+        ctx = mp.get_context('forkserver')
+
+        self.buffer = ctx.RawArray('b', self.slot_size * depth)
+        self.taken = ctx.RawArray('b', len(self.indices))
+        self.n_taken = 0
+        self.consumed = ctx.Value('q', 0, lock=False)  # First position not taken
+        self.cond = ctx.Condition()
+        self.results = ctx.Queue()
+        self.ready = {}
+
+        self.workers = []
+        for w in range(min(n_workers, len(self.indices) - 1)):
+            items = [(pos, self.indices[pos]) for pos in range(1 + w, len(self.indices), n_workers)]
+            self.workers.append(ctx.Process(
+                target=prefetch_work, daemon=True,
+                args=(fn, items, self.buffer, self.taken, self.consumed, self.cond, self.results, depth, self.slot_size)))
+        for w in self.workers:
+            w.start()
+
+    @property
+    def remaining(self):
+        return len(self.indices) - self.n_taken
+
+    def get(self, pos=None):
+        if pos is None:
+            if self.remaining <= 0:
+                raise IndexError("All %d batches are consumed" % len(self.indices))
+            pos = self.consumed.value
+
+        if pos == 0 and self.first is not None:
+            batch, self.first = self.first, None
+        elif self.taken[pos] or pos >= self.consumed.value + self.depth:
+            batch = self.fn(self.indices[pos])
+        else:
+            batch = self._receive(pos)
+
+        if not self.taken[pos]:
+            self.n_taken += 1
+            with self.cond:
+                self.taken[pos] = 1
+                while self.consumed.value < len(self.indices) and self.taken[self.consumed.value]:
+                    self.consumed.value += 1
+                self.cond.notify_all()
+
+        return batch
+
+    def close(self):
+        for w in self.workers:
+            w.terminate()
+        for w in self.workers:
+            w.join()
+        self.results.close()
+        self.workers = []
+
+    def _receive(self, pos):
+        while pos not in self.ready:
+            p, spec, layout, batch = self._next_result()
+            if spec == 'error':
+                raise RuntimeError("Batch %d failed in prefetch worker:\n%s" % (self.indices[p], batch))
+            self.ready[p] = spec, layout, batch
+
+        spec, layout, batch = self.ready.pop(pos)
+        if layout is None:
+            return batch
+
+        # Slot of position p is rewritten only after p is taken (workers skip taken positions), so copying it out here is safe
+        buf = np.frombuffer(self.buffer, dtype=np.uint8)
+        leaves = [buf[ofs:ofs+np.dtype(dtype).itemsize*int(np.prod(shape))].view(dtype).reshape(shape).copy() for dtype, shape, ofs in layout]
+        return unflatten_batch(spec, leaves)
+
+    def _next_result(self):
+        while True:
+            try:
+                return self.results.get(timeout=self.poll_interval)
+            except queue.Empty:
+                pass
+
+            failed = [w.exitcode for w in self.workers if w.exitcode not in (None, 0)]
+            if len(failed) > 0:
+                raise RuntimeError("Prefetch worker died with exit code %d" % failed[0])
+
+            if all(w.exitcode == 0 for w in self.workers):  # Workers flush their results before exiting
+                try:
+                    return self.results.get(timeout=self.poll_interval)
+                except queue.Empty:
+                    raise RuntimeError("Prefetch workers exited without producing all batches")
@@ -0,0 +1,152 @@
+import itertools
+
+import numpy as np
+
+from src.augmentations import object_array
+
+
+def is_text_column(col):
+    return col == 'comment_text' or col.startswith('comment_text__')
+
+
+def tokenize_text_columns(tokenizer, X):
+    """ Copy of X with comment text (and its translations) replaced by int32 token id arrays """
+    res = X.copy()
+    for col in res.columns:
+        if is_text_column(col):
+            texts = X[col].values
+            is_text = np.array([isinstance(t, str) for t in texts], dtype=np.bool_)
+
+            ids = texts.copy()
+            ids[is_text] = object_array([np.array(seq, dtype=np.int32) for seq in tokenizer.texts_to_sequences(list(texts[is_text]))])
+            res[col] = ids
+    return res
+
+
+class TokenizedFrames:
+    """
+    tokenize_text_columns results for the last few (frame, tokenizer) pairs, so sequences built again over
+    the same frame (every predict pass of test time augmentation, every train schedule stage) tokenize it once.
+    Frames are matched by identity or equal contents, entries aren't pickled with their owner.
+    """
+
+    def __init__(self, size=4):
+        self.size = size
+        self.entries = []
+
+    def get(self, tokenizer, X):
+        for i, (x, t, res) in enumerate(self.entries):
+            if t is tokenizer and (x is X or (x.shape == X.shape and x.equals(X))):
+                self.entries.insert(0, self.entries.pop(i))
+                return res
+
+        res = tokenize_text_columns(tokenizer, X)
+        self.entries = [(X, tokenizer, res)] + self.entries[:self.size-1]
+        return res
+
+    def __getstate__(self):
+        return {'size': self.size, 'entries': []}
+
+
+def detokenize_text_columns(tokenizer, X):
+    """ Inverse of tokenize_text_columns, tokenizing resulting texts gives the same ids back """
+    words = {i: w for w, i in tokenizer.word_index.items()}
+    sep = '' if getattr(tokenizer, 'char_level', False) else getattr(tokenizer, 'split', ' ')
+
+    res = X.copy()
+    for col in res.columns:
+        if is_text_column(col):
+            res[col] = [sep.join(words[i] for i in ids) if isinstance(ids, np.ndarray) else ids for ids in X[col].values]
+    return res
+
+
+def pad_ids(seqs, maxlen, padding='pre', truncating='pre', dtype=np.int32):
+    """ Same as keras pad_sequences with maxlen given """
+    res = np.zeros((len(seqs), maxlen), dtype=dtype)
+    for i, seq in enumerate(seqs):
+        seq = seq[-maxlen:] if truncating == 'pre' else seq[:maxlen]
+        if len(seq) > 0:
+            if padding == 'pre':
+                res[i, maxlen-len(seq):] = seq
+            else:
+                res[i, :len(seq)] = seq
+    return res
+
+
+def batch_equal(a, b):
+    if isinstance(a, dict):
+        return isinstance(b, dict) and a.keys() == b.keys() and all(batch_equal(a[k], b[k]) for k in a)
+    if isinstance(a, (tuple, list)):
+        return isinstance(b, (tuple, list)) and len(a) == len(b) and all(batch_equal(x, y) for x, y in zip(a, b))
+
+    a, b = np.asarray(a), np.asarray(b)
+    return a.dtype == b.dtype and a.shape == b.shape and np.array_equal(a, b)
+
+
+class TokenIdTransform:
+    """
+    Batch transform of frames with token id arrays, equal to the data transformer batch transform of their texts.
+
+    Model inputs are built directly from ids: `comment_text` padded to data.max_text_len and `numeric_columns__`
+    from data.numeric_columns. Padding, truncation and dtypes are calibrated on a probe of texts, which is passed
+    through the data transformer itself (`transform`) and checked against directly built inputs.
+    If no combination matches, batches are detokenized and passed through the data transformer instead.
+    """
+
+    probe_size = 32
+
+    def __init__(self, data, transform, X, y=None):
+        self.data = data
+        self.transform = transform
+        self.options = self._calibrate(X, y)
+
+    def __call__(self, batch_x, batch_y=None):
+        if self.options is None:
+            return self._transform(detokenize_text_columns(self.data.text_tokenizer, batch_x), batch_y)
+
+        return self._build(batch_x, batch_y, *self.options)
+
+    def _transform(self, batch_x, batch_y):
+        return self.transform(batch_x) if batch_y is None else self.transform(batch_x, batch_y)
+
+    def _build(self, batch_x, batch_y, padding, truncating, dtypes, y_dtype):
+        res = {}
+        for key, dtype in dtypes.items():
+            if key == 'comment_text':
+                res[key] = pad_ids(batch_x['comment_text'].values, self.data.max_text_len, padding, truncating, dtype)
+            else:
+                res[key] = batch_x[self.data.numeric_columns].values.astype(dtype)
+
+        if batch_y is None:
+            return res
+        return res, np.asarray(batch_y).astype(y_dtype)
+
+    def _calibrate(self, X, y):
+        tokenizer = self.data.text_tokenizer
+        num_words = tokenizer.num_words or len(tokenizer.word_index) + 1
+
+        # Probe rows get a short and an overlong text of vocabulary words, so padding and truncation both show
+        words = [w for w, i in sorted(tokenizer.word_index.items(), key=lambda p: p[1]) if i < num_words]
+        probe_x = X.iloc[:self.probe_size].copy()
+        if len(words) > 0 and len(probe_x) >= 2:
+            texts = probe_x['comment_text'].values.copy()
+            texts[0] = words[0]
+            texts[1] = ' '.join(itertools.islice(itertools.cycle(words), self.data.max_text_len + 3))
+            probe_x['comment_text'] = texts
+        probe_y = None if y is None else y.iloc[:self.probe_size]
+
+        expected = self._transform(probe_x, probe_y)
+        expected_x, expected_y = expected if isinstance(expected, tuple) else (expected, None)
+        if not isinstance(expected_x, dict) or not set(expected_x) <= {'comment_text', 'numeric_columns__'}:
+            return None
+
+        dtypes = {k: np.asarray(v).dtype for k, v in expected_x.items()}
+        y_dtype = None if expected_y is None else np.asarray(expected_y).dtype
+
+        probe_ids = tokenize_text_columns(tokenizer, probe_x)
+        for padding, truncating in itertools.product(['pre', 'post'], ['pre', 'post']):
+            options = padding, truncating, dtypes, y_dtype
+            if batch_equal(self._build(probe_ids, probe_y, *options), expected):
+                return options
+
+        return None
@@ -0,0 +1,115 @@
+import os
+import hashlib
+import sqlite3
+
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
+
+
+class TextBlobBackend:
+    """ Round-trip translation (to language and back to english) through TextBlob, requests of a batch are run in a thread pool """
+
+    name = 'textblob'
+    version = 1
+
+    def __init__(self, n_threads=16):
+        self.n_threads = n_threads
+
+    def translate_batch(self, texts, language):
+        with ThreadPoolExecutor(self.n_threads) as pool:
+            return list(pool.map(lambda text: self.translate(text, language), texts))
+
+    def translate(self, text, language):
+        from textblob import TextBlob
+        from textblob.translate import NotTranslated
+
+        blob = TextBlob(text)
+        try:
+            blob = blob.translate(to=language)
+            blob = blob.translate(to="en")
+        except NotTranslated:
+            pass
+
+        return str(blob)
+
+
+class StubBackend:
+    """ Deterministic local stand-in for translation service, reverses word order and tags text with language """
+
+    name = 'stub'
+    version = 1
+
+    def translate_batch(self, texts, language):
+        return ['%s: %s' % (language, ' '.join(reversed(text.split()))) for text in texts]
+
+
+backends = dict(textblob=TextBlobBackend, stub=StubBackend)
+
+
+class TranslationCache:
+    """
+    Persistent translations keyed by hash of backend, language and text, stored in sqlite database shared by processes.
+    Backend is identified by its name and version, so translations of different backends (or backend versions) never mix.
+    """
+
+    def __init__(self, filename):
+        self.filename = filename
+
+    @staticmethod
+    def key(text, language, backend):
+        return hashlib.sha1(('%s/%d\0%s\0%s' % (backend.name, backend.version, language, text)).encode('utf-8')).hexdigest()
+
+    def get_many(self, keys, chunk_size=500):
+        res = {}
+        if not os.path.exists(self.filename):
+            return res
+
+        with self._connect() as conn:
+            for ofs in range(0, len(keys), chunk_size):
+                chunk = keys[ofs:ofs+chunk_size]
+                res.update(conn.execute('SELECT key, translation FROM translations WHERE key IN (%s)' % ','.join('?' * len(chunk)), chunk))
+        return res
+
+    def put_many(self, translations):
+        os.makedirs(os.path.dirname(self.filename), exist_ok=True)
+        with self._connect() as conn:
+            conn.executemany('INSERT OR REPLACE INTO translations VALUES (?, ?)', translations.items())
+
+    @contextmanager
+    def _connect(self):
+        conn = sqlite3.connect(self.filename, timeout=600)
+        try:
+            with conn:  # Commit on success
+                conn.execute('CREATE TABLE IF NOT EXISTS translations (key TEXT PRIMARY KEY, translation TEXT NOT NULL)')
+                yield conn
+        finally:
+            conn.close()
+
+
+class Translator:
+    """
+    Translates texts with backend in batches of distinct texts, skipping the ones already in cache.
+    Every translated batch is saved to cache at once, so interrupted job resumes from the last batch.
+    """
+
+    def __init__(self, backend, cache, batch_size=200):
+        self.backend = backend
+        self.cache = cache
+        self.batch_size = batch_size
+
+    def translate(self, texts, language):
+        keys = {text: TranslationCache.key(text, language, self.backend) for text in texts if isinstance(text, str)}
+        known = self.cache.get_many(list(set(keys.values())))
+
+        missing = [text for text, key in keys.items() if key not in known]
+        if len(missing) > 0:
+            print('Translating %d of %d distinct texts to "%s"...' % (len(missing), len(keys), language))
+
+        for ofs in range(0, len(missing), self.batch_size):
+            batch = missing[ofs:ofs+self.batch_size]
+            translated = {keys[text]: tr for text, tr in zip(batch, self.backend.translate_batch(batch, language))}
+
+            self.cache.put_many(translated)
+            known.update(translated)
+
+        return [known[keys[text]] if isinstance(text, str) else text for text in texts]
@@ -0,0 +1,57 @@
+import random
+from collections import Counter
+
+import pandas as pd
+import pytest
+
+from src.features import Corrector, Corrector2
+from src.util.correction_cache import CorrectionCache
+
+
+def random_word(rnd, lo, hi, letters='abcde1'):
+    return ''.join(rnd.choice(letters) for _ in range(rnd.randint(lo, hi)))
+
+
+def gen_vocs(seed):
+    """ Two overlapping vocabularies: B changes some frequencies of A, drops some words and adds new ones """
+    rnd = random.Random(seed)
+    voc_a = Counter({random_word(rnd, 2, 8): rnd.choice([1, 2, 3, 101, 200]) for _ in range(300)})
+
+    voc_b = Counter(voc_a)
+    for w in rnd.sample(sorted(voc_a), 30):
+        voc_b[w] = rnd.choice([1, 2, 150])
+    for w in rnd.sample(sorted(voc_a), 30):
+        del voc_b[w]
+    for _ in range(40):
+        voc_b[random_word(rnd, 2, 8)] = rnd.choice([1, 5, 300])
+
+    words = [random_word(rnd, 1, 14) for _ in range(400)] + [random_word(rnd, 14, 24) for _ in range(20)]
+    return voc_a, voc_b, words
+
+
+@pytest.mark.parametrize('corrector_cls', [Corrector, Corrector2])
+@pytest.mark.parametrize('seed', [0, 1])
+def test_persisted_corrections_reused_with_other_vocabulary(tmp_path, corrector_cls, seed):
+    voc_a, voc_b, words = gen_vocs(seed)
+    texts = pd.DataFrame({'comment_text': [' '.join(words[i:i+7]) for i in range(0, len(words), 7)]})
+
+    expected = corrector_cls(voc_b).apply(texts)
+
+    cache = CorrectionCache(str(tmp_path / 'corrections.sqlite'))
+    corrector_a = corrector_cls(voc_a, cache)
+    corrector_a.load_cache()
+    corrector_a.apply(texts)
+
+    corrector_b = corrector_cls(voc_b, cache)
+    corrector_b.load_cache()
+    reused = set(corrector_b.cache)
+    assert len(reused) > 0
+
+    pd.testing.assert_frame_equal(corrector_b.apply(texts), expected)
+    assert all(corrector_b.cache[w] == corrector_cls(voc_b).correct(w) for w in reused)
+
+    # Corrections made with the same vocabulary are all reused
+    corrector_b2 = corrector_cls(voc_b, cache)
+    corrector_b2.load_cache()
+    pd.testing.assert_frame_equal(corrector_b2.apply(texts), expected)
+    assert corrector_b2.computed == []
@@ -0,0 +1,68 @@
+import numpy as np
+import pytest
+
+from src.util.embeddings import load_emb_matrix
+
+
+def write_emb_file(path, header=True):
+    lines = [
+        'the 0.1 0.2 0.3',
+        'cat -1.5 2.0 0.25',
+        'dog 3 4 5',
+        'cat 7 8 9',  # Duplicate token, later row wins
+        'unused 1 1 1',
+        'rare 0.5 0.5 0.5',
+        'dog 1 2',  # Malformed duplicate, earlier vector is kept
+        'broken 1 2 3 4',
+    ]
+    with open(path, 'w') as f:
+        f.write('\n'.join((['%d 3' % len(lines)] if header else []) + lines) + '\n')
+    return str(path)
+
+
+word_index = {'the': 1, 'cat': 2, 'broken': 3, 'dog': 4, 'rare': 6}
+
+
+def reference_emb_matrix(filename, word_index, voc_size, emb_size, rand_std=None):
+    """ Line by line loader with semantics of the Keras models loader: known words of first voc_size ids get their vectors """
+    if rand_std is None:
+        res = np.zeros((voc_size, emb_size))
+    else:
+        res = np.random.normal(0, rand_std, (voc_size, emb_size))
+
+    with open(filename) as f:
+        for line in f:
+            parts = line.split()
+            idx = word_index.get(parts[0])
+            if idx is not None and idx < voc_size and len(parts) == emb_size + 1:
+                res[idx] = np.array(parts[1:], dtype=np.float32)
+    return res
+
+
+@pytest.mark.parametrize('header', [True, False])
+@pytest.mark.parametrize('rand_std', [None, 0.3])
+def test_matches_reference(tmp_path, header, rand_std):
+    filename = write_emb_file(tmp_path / 'emb.txt', header)
+
+    np.random.seed(1)
+    expected = reference_emb_matrix(filename, word_index, 5, 3, rand_std=rand_std)
+    np.random.seed(1)
+    res = load_emb_matrix(filename, word_index, 5, 3, rand_std=rand_std, cache_dir=str(tmp_path / 'cache'))
+
+    assert res.shape == (5, 3)
+    np.testing.assert_allclose(res, expected, rtol=1e-6)
+    np.testing.assert_array_equal(res[2], [7, 8, 9])
+    np.testing.assert_array_equal(res[4], [3, 4, 5])
+
+
+def test_matches_kgutil(tmp_path):
+    kgutil_rnn = pytest.importorskip('kgutil.models.keras.rnn', reason="kgutil (private requirement) isn't installed, equivalence with its loader isn't checked")
+    filename = write_emb_file(tmp_path / 'emb.txt')
+
+    for rand_std in [None, 0.3]:
+        np.random.seed(2)
+        expected = kgutil_rnn.load_emb_matrix(filename, word_index, 5, 3, **({} if rand_std is None else dict(rand_std=rand_std)))
+        np.random.seed(2)
+        res = load_emb_matrix(filename, word_index, 5, 3, rand_std=rand_std, cache_dir=str(tmp_path / 'cache'))
+
+        np.testing.assert_allclose(res, np.asarray(expected, dtype=np.float32), rtol=1e-6)
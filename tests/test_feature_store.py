@@ -0,0 +1,50 @@
+import multiprocessing as mp
+
+import numpy as np
+import pandas as pd
+
+from src.util.feature_store import FeatureStore
+
+
+def version_frame(k, n=50):
+    return pd.DataFrame({'a': np.full(n, k), 'b': ['%d' % k] * n}, index=pd.Index(['%d-%d' % (k, i) for i in range(n)], name='id'))
+
+
+def write_versions(directory, k):
+    store = FeatureStore(directory)
+    for i in range(40):
+        store.save('f', version_frame(k * 1000 + i), row_hashes=np.full(50, k * 1000 + i, dtype=np.uint64))
+
+
+def test_save_load_roundtrip(tmp_path):
+    store = FeatureStore(str(tmp_path))
+    df = version_frame(3)
+    store.save('f', df, row_hashes=np.arange(50), fingerprint='x')
+
+    pd.testing.assert_frame_equal(store.load('f'), df)
+    pd.testing.assert_frame_equal(store.load('f', columns=['b']), df[['b']])
+    assert store.read_meta('f')['fingerprint'] == 'x'
+    np.testing.assert_array_equal(store.load_row_hashes('f'), np.arange(50))
+
+
+def test_load_sees_single_version_during_saves(tmp_path):
+    store = FeatureStore(str(tmp_path))
+    store.save('f', version_frame(0))
+
+    writers = [mp.get_context('fork').Process(target=write_versions, args=(str(tmp_path), k)) for k in range(1, 4)]
+    for w in writers:
+        w.start()
+
+    reads = 0
+    while any(w.is_alive() for w in writers) or reads == 0:
+        res = store.load('f')
+        k = res['a'].iloc[0]
+        assert (res['a'] == k).all() and (res['b'] == str(k)).all()
+        assert all(i.startswith('%d-' % k) for i in res.index)
+        reads += 1
+
+    for w in writers:
+        w.join()
+        assert w.exitcode == 0
+
+    assert store.load('f')['a'].iloc[0] % 1000 == 39
@@ -0,0 +1,95 @@
+import time
+import asyncio
+import hashlib
+import threading
+from contextlib import contextmanager
+
+import numpy as np
+import pandas as pd
+import pytest
+
+aiohttp = pytest.importorskip('aiohttp')
+from aiohttp import web
+
+from src.tools.api_stub import make_app
+from src.util.perspective import AnalyzeClient, TokenBucket, analyze_comments, attributes, split_text
+
+
+@contextmanager
+def run_stub(**kwargs):
+    """ api_stub app served on a free local port from a background thread, yields its url and (arrival time, status) of requests """
+    requests = []
+
+    @web.middleware
+    async def record(request, handler):
+        now = time.monotonic()
+        resp = await handler(request)
+        requests.append((now, resp.status))
+        return resp
+
+    app = make_app(**kwargs)
+    app.middlewares.append(record)
+
+    loop = asyncio.new_event_loop()
+    runner = web.AppRunner(app)
+    loop.run_until_complete(runner.setup())
+    site = web.TCPSite(runner, '127.0.0.1', 0)
+    loop.run_until_complete(site.start())
+    port = runner.addresses[0][1]
+
+    thread = threading.Thread(target=loop.run_forever, daemon=True)
+    thread.start()
+    try:
+        yield 'http://127.0.0.1:%d/v1alpha1/comments:analyze' % port, requests
+    finally:
+        loop.call_soon_threadsafe(loop.stop)
+        thread.join()
+        loop.run_until_complete(runner.cleanup())
+        loop.close()
+
+
+def stub_score(attribute, text):
+    return int(hashlib.md5((attribute + text).encode()).hexdigest()[:8], 16) / 2 ** 32
+
+
+def test_analyze_comments_retries_in_order(tmp_path):
+    rs = np.random.RandomState(0)
+    words = ['you', 'are', 'nice', 'bad', 'ok.', 'what?']
+    texts = [' '.join(rs.choice(words, rs.randint(1, 30))) for _ in range(60)]
+    texts[7] = ' '.join(rs.choice(words, 1500))  # Longer than request limit, analyzed in parts
+    texts = pd.Series(texts, index=rs.permutation(1000)[:60])
+
+    # Initial burst of client rate limiter exceeds stub qps, so some requests are rate limited too
+    with run_stub(qps=18, fail_rate=0.2) as (url, requests):
+        res = analyze_comments(texts, str(tmp_path / 'log.jsonl'), url=url, rate=15, concurrency=8, timeout=10, max_retries=10, backoff=0.1)
+
+    statuses = {s for _, s in requests}
+    assert 429 in statuses and 503 in statuses  # Rate limited and failed requests were retried
+
+    assert list(res.index) == list(texts.index)
+    for text, resp in zip(texts, res):
+        assert set(resp) == set(attributes)
+        parts = split_text(text, 2000, 2900)
+        for k in attributes:
+            assert resp[k]['summaryScore']['value'] == pytest.approx(np.mean([stub_score(k, p) for p in parts]))
+
+
+def test_client_rate_limit():
+    async def analyze_all(url, texts):
+        limiter = TokenBucket(20, capacity=2)
+        async with aiohttp.ClientSession() as session:
+            client = AnalyzeClient(session, limiter, None, url, max_retries=0)
+            return await asyncio.gather(*[client.analyze(t) for t in texts])
+
+    texts = ['text %d' % i for i in range(30)]
+    with run_stub(qps=25) as (url, requests):
+        loop = asyncio.new_event_loop()
+        try:
+            res = loop.run_until_complete(analyze_all(url, texts))
+        finally:
+            loop.close()
+
+    times = np.array(sorted(t for t, _ in requests))
+    assert all(s == 200 for _, s in requests)
+    assert times[-1] - times[0] >= (len(texts) - 2) / 20 * 0.9
+    assert [r['TOXICITY']['summaryScore']['value'] for r in res] == [stub_score('TOXICITY', t) for t in texts]
@@ -0,0 +1,108 @@
+import os
+import threading
+
+import numpy as np
+import pytest
+
+from src.util.prefetch import BatchPrefetcher
+
+
+def make_batch(i):
+    rs = np.random.RandomState(i)
+    n = 64 if i < 20 else 10
+    x = {'comment_text': rs.randint(0, 1000, (n, 50)).astype(np.int32), 'numeric_columns__': rs.rand(n, 5).astype(np.float32)}
+    if i == 7:
+        x['extra'] = np.zeros((300, 300))  # Doesn't fit into slot, passed pickled
+    return x, rs.rand(n, 6)
+
+
+def full_batch(i):
+    return np.full(3, i)
+
+
+def failing_batch(i):
+    if i == 3:
+        raise KeyError('bad batch')
+    return np.zeros(3)
+
+
+def exiting_batch(i):
+    if i == 2:
+        os._exit(3)
+    return np.zeros(3)
+
+
+def assert_batch_equal(a, b):
+    (a_x, a_y), (b_x, b_y) = a, b
+    assert a_x.keys() == b_x.keys()
+    for k in a_x:
+        assert a_x[k].dtype == b_x[k].dtype
+        np.testing.assert_array_equal(a_x[k], b_x[k])
+    np.testing.assert_array_equal(a_y, b_y)
+
+
+@pytest.mark.parametrize('n_workers, depth', [(1, 1), (3, 2), (4, 8), (30, 3)])
+def test_batches_in_order_of_indices(n_workers, depth):
+    order = np.random.RandomState(0).permutation(21)
+    prefetcher = BatchPrefetcher(make_batch, order, n_workers, depth)
+    try:
+        for i in order:
+            assert_batch_equal(prefetcher.get(), make_batch(i))
+        assert prefetcher.remaining == 0
+        with pytest.raises(IndexError):
+            prefetcher.get()
+    finally:
+        prefetcher.close()
+
+
+@pytest.mark.parametrize('depth', [1, 3])
+def test_batches_by_position(depth):
+    order = np.random.RandomState(1).permutation(21)
+    prefetcher = BatchPrefetcher(make_batch, order, 3, depth)
+    try:
+        # Ahead of the window, in the window, again after taken, then the rest in order
+        for pos in [5, 1, 2, 0, 1, 3, 20, 4] + list(range(6, 20)):
+            assert_batch_equal(prefetcher.get(pos), make_batch(order[pos]))
+        assert prefetcher.remaining == 0
+    finally:
+        prefetcher.close()
+
+
+def test_concurrent_consumers():
+    prefetcher = BatchPrefetcher(full_batch, range(40), 3, 4)
+    lock, res = threading.Lock(), []
+
+    def consume():
+        for _ in range(10):
+            with lock:
+                res.append(int(prefetcher.get()[0]))
+
+    threads = [threading.Thread(target=consume) for _ in range(4)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    prefetcher.close()
+
+    assert res == list(range(40))
+
+
+def test_worker_error():
+    prefetcher = BatchPrefetcher(failing_batch, range(6), 2, 2)
+    try:
+        with pytest.raises(RuntimeError, match='Batch 3 failed'):
+            for _ in range(6):
+                prefetcher.get()
+    finally:
+        prefetcher.close()
+
+
+def test_dead_worker():
+    prefetcher = BatchPrefetcher(exiting_batch, range(6), 2, 2)
+    prefetcher.poll_interval = 0.1
+    try:
+        with pytest.raises(RuntimeError, match='exit code 3'):
+            for _ in range(6):
+                prefetcher.get()
+    finally:
+        prefetcher.close()
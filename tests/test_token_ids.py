@@ -0,0 +1,120 @@
+import pickle
+import re
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from src.augmentations import RandomCropIds
+from src.util.token_ids import TokenIdTransform, TokenizedFrames, tokenize_text_columns, pad_ids
+
+
+class Tokenizer:
+    """ Word-level tokenizer with the keras Tokenizer interface used by TokenIdTransform """
+
+    split = ' '
+    char_level = False
+
+    def __init__(self, texts, num_words=None):
+        counts = pd.Series([w for t in texts for w in self._words(t)]).value_counts()
+        self.word_index = {w: i + 1 for i, w in enumerate(counts.index)}
+        self.num_words = num_words
+
+    def _words(self, text):
+        return [w for w in re.split('[^a-z0-9]+', text.lower()) if w]
+
+    def texts_to_sequences(self, texts):
+        return [[self.word_index[w] for w in self._words(t) if w in self.word_index and (self.num_words is None or self.word_index[w] < self.num_words)] for t in texts]
+
+
+class DataTransformer:
+    """ String path of the data transformer: tokenize texts and pad them """
+
+    def __init__(self, texts, max_text_len, padding, truncating, numeric_columns=(), extra_input=False):
+        self.text_tokenizer = Tokenizer(texts, num_words=40)
+        self.max_text_len = max_text_len
+        self.padding = padding
+        self.truncating = truncating
+        self.numeric_columns = list(numeric_columns)
+        self.extra_input = extra_input
+
+    def transform_batch(self, batch_x, batch_y=None):
+        seqs = self.text_tokenizer.texts_to_sequences(list(batch_x['comment_text'].values))
+        res = {'comment_text': pad_ids(seqs, self.max_text_len, self.padding, self.truncating, np.int32)}
+        if len(self.numeric_columns) > 0:
+            res['numeric_columns__'] = batch_x[self.numeric_columns].values.astype(np.float32)
+        if self.extra_input:
+            res['lengths'] = np.array([len(s) for s in seqs])
+
+        if batch_y is None:
+            return res
+        return res, batch_y.values.astype(np.float32)
+
+
+def gen_data(n=60, seed=0):
+    rs = np.random.RandomState(seed)
+    vocab = ['word%d' % i for i in range(80)] + ['Some', 'CAPS', 'text!']
+    texts = [' '.join(rs.choice(vocab, rs.randint(0, 25))) for _ in range(n)]
+    X = pd.DataFrame({'comment_text': texts, 'num1': rs.rand(n), 'num2': rs.rand(n)})
+    y = pd.DataFrame(rs.rand(n, 6) > 0.5, columns=['t%d' % i for i in range(6)])
+    return X, y
+
+
+def assert_batch_equal(a, b):
+    a_x, a_y = a
+    b_x, b_y = b
+
+    assert a_x.keys() == b_x.keys()
+    for k in a_x:
+        assert a_x[k].dtype == b_x[k].dtype
+        np.testing.assert_array_equal(a_x[k], b_x[k])
+
+    assert a_y.dtype == b_y.dtype
+    np.testing.assert_array_equal(a_y, b_y)
+
+
+@pytest.mark.parametrize('padding', ['pre', 'post'])
+@pytest.mark.parametrize('truncating', ['pre', 'post'])
+@pytest.mark.parametrize('extra_input', [False, True])
+def test_id_path_equals_string_path(padding, truncating, extra_input):
+    X, y = gen_data()
+    data = DataTransformer(X['comment_text'], 10, padding, truncating, ['num1', 'num2'], extra_input=extra_input)
+
+    transform = TokenIdTransform(data, data.transform_batch, X, y)
+    if extra_input:
+        assert transform.options is None  # Inputs can't be built from ids, detokenized fallback is used
+    else:
+        assert transform.options[:2] == (padding, truncating)
+
+    # Identity crop on ids, batches with both short and truncated texts
+    X_ids = RandomCropIds(min_len=1.0, max_len=1.0).transform(tokenize_text_columns(data.text_tokenizer, X))
+    for batch in [slice(0, 20), slice(20, 60)]:
+        assert_batch_equal(transform(X_ids.iloc[batch], y.iloc[batch]), data.transform_batch(X.iloc[batch], y.iloc[batch]))
+
+
+def test_id_path_without_targets():
+    X, _ = gen_data()
+    data = DataTransformer(X['comment_text'], 12, 'post', 'post')
+
+    transform = TokenIdTransform(data, data.transform_batch, X)
+    res = transform(tokenize_text_columns(data.text_tokenizer, X))
+    expected = data.transform_batch(X)
+
+    assert res.keys() == expected.keys()
+    np.testing.assert_array_equal(res['comment_text'], expected['comment_text'])
+
+
+def test_tokenized_frames_reused():
+    X, _ = gen_data()
+    X2, _ = gen_data(seed=1)
+    data = DataTransformer(X['comment_text'], 12, 'post', 'post')
+    frames = TokenizedFrames(size=2)
+
+    res = frames.get(data.text_tokenizer, X)
+    pd.testing.assert_frame_equal(res, tokenize_text_columns(data.text_tokenizer, X))
+    assert frames.get(data.text_tokenizer, X2) is not res
+    assert frames.get(data.text_tokenizer, X) is res
+    assert frames.get(data.text_tokenizer, X.copy()) is res  # Equal frame
+    assert frames.get(Tokenizer(X['comment_text']), X) is not res  # Other tokenizer
+
+    assert pickle.loads(pickle.dumps(frames)).entries == []